@@ -0,0 +1,80 @@
+"""
+Compares CPU time per frame and output bitrate of the Opus encoder
+with its default settings and with settings matched to voice channels
+of different bitrates
+
+Usage: python -m benchmarks.encoder_settings [file or url] [bitrates ...]
+Needs FFmpeg, without a file it encodes noise and a tone from its
+generators, real music gives more meaningful numbers
+"""
+
+import sys
+import time
+from typing import List, Optional
+
+import discord
+from discord.opus import Encoder
+
+from config import config
+from musicbot import encoding
+
+GENERATED = "anoisesrc=d=30:c=pink:a=0.2[a];sine=f=330:d=30[b];[a][b]amix"
+CHANNEL_BITRATES = [64, 96, 128, 384]
+
+
+def decode(source: Optional[str]) -> List[bytes]:
+    "Returns PCM frames of the source"
+    if source is None:
+        track = discord.FFmpegPCMAudio(GENERATED, before_options="-f lavfi")
+    else:
+        track = discord.FFmpegPCMAudio(source)
+    frames = []
+    while True:
+        frame = track.read()
+        if not frame:
+            break
+        frames.append(frame)
+    track.cleanup()
+    return frames
+
+
+def measure(
+    frames: List[bytes], settings: Optional[encoding.EncoderSettings]
+) -> str:
+    encoder = Encoder()
+    if settings:
+        encoding.configure(encoder, settings)
+    size = 0
+    start = time.process_time()
+    for frame in frames:
+        size += len(encoder.encode(frame, Encoder.SAMPLES_PER_FRAME))
+    cpu = time.process_time() - start
+    audio = len(frames) * Encoder.FRAME_LENGTH / 1000
+    return "{:6.1f} us per frame, {:5.1f} kbps".format(
+        cpu / len(frames) * 1e6, size * 8 / audio / 1000
+    )
+
+
+def main():
+    args = sys.argv[1:]
+    source = None
+    if args and not args[0].isdigit():
+        source = args.pop(0)
+    bitrates = [int(n) for n in args] or CHANNEL_BITRATES
+    frames = decode(source)
+    if not frames:
+        print("Nothing was decoded")
+        sys.exit(1)
+    config.MATCH_CHANNEL_BITRATE = True
+
+    print(f"{'default settings':>34}: {measure(frames, None)}")
+    for bitrate in bitrates:
+        settings = encoding.settings_for(bitrate)
+        name = "{} kbps, complexity {}{}".format(
+            bitrate, settings.complexity, ", FEC" if settings.fec else ""
+        )
+        print(f"{name:>34}: {measure(frames, settings)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Compares throughput of encoding PCM streams in the bot process
+and in encoding worker processes, reading many streams at once
+as fast as they are produced
+
+Usage: python -m benchmarks.encoding [seconds of audio] [streams ...]
+Needs FFmpeg, streams are generated by its sine source
+"""
+
+import sys
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import discord
+
+from config import config
+from musicbot import encoding, sources
+
+SOURCE = "sine=frequency=440:sample_rate=48000"
+BEFORE_OPTIONS = "-f lavfi"
+# reader threads, like the audio scheduler uses
+READERS = 4
+
+
+def open_stream(remote: bool, seconds: float):
+    options = f"{sources.FFMPEG_OPTIONS} -t {seconds}"
+    if remote:
+        track = encoding.RemoteTrack(SOURCE, BEFORE_OPTIONS, options)
+    else:
+        track = discord.FFmpegPCMAudio(
+            SOURCE, before_options=BEFORE_OPTIONS, options=options
+        )
+    # not 100% so the volume is applied as it would be in the bot
+    return sources.PlaybackSource(track, 0.8)
+
+
+def measure(remote: bool, streams: int, seconds: float):
+    playbacks = [open_stream(remote, seconds) for _ in range(streams)]
+    frames = 0
+    lock = threading.Lock()
+
+    def read_all(playback):
+        nonlocal frames
+        count = 0
+        while playback.read():
+            count += 1
+        with lock:
+            frames += count
+
+    start_cpu = time.process_time()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(READERS) as executor:
+        list(executor.map(read_all, playbacks))
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - start_cpu
+    for playback in playbacks:
+        playback.cleanup()
+
+    name = f"{config.ENCODER_PROCESSES} processes" if remote else "in-process"
+    print(
+        f"{name:>12} {streams:4} streams:"
+        f" {frames * sources.FRAME_LENGTH / elapsed:7.1f} real-time streams,"
+        f" bot process CPU {cpu / elapsed * 100:5.1f}%"
+    )
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    counts = [int(n) for n in sys.argv[2:]] or [8, 32, 64]
+    if not config.ENCODER_PROCESSES:
+        config.ENCODER_PROCESSES = 4
+    for streams in counts:
+        measure(False, streams, seconds)
+        measure(True, streams, seconds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Simulates extraction through the identity pool
+with a fake extractor that throttles every identity separately
+
+Run from the repository root: python -m benchmarks.identity_pool
+"""
+
+from collections import defaultdict, deque
+
+from musicbot.identities import Identity, IdentityPool
+
+JOBS = 2000
+# seconds between jobs
+JOB_INTERVAL = 1
+IDENTITIES = 4
+COOLDOWN = 30
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeExtractor:
+    "Allows every identity `limit` requests per `window` seconds"
+
+    def __init__(self, clock: FakeClock, limit: int = 40, window: float = 60):
+        self.clock = clock
+        self.limit = limit
+        self.window = window
+        self.requests = defaultdict(deque)
+
+    def extract(self, identity: Identity) -> bool:
+        "Returns False if the request was throttled"
+        now = self.clock()
+        history = self.requests[identity.name]
+        while history and history[0] <= now - self.window:
+            history.popleft()
+        history.append(now)
+        return len(history) <= self.limit
+
+
+def simulate(identity_count: int) -> int:
+    clock = FakeClock()
+    extractor = FakeExtractor(clock)
+    pool = IdentityPool(
+        [Identity(f"cookies{i}.txt") for i in range(identity_count)],
+        COOLDOWN,
+        clock,
+    )
+    failed = 0
+    for _ in range(JOBS):
+        clock.now += JOB_INTERVAL
+        # the loader retries with every identity once
+        for _ in range(len(pool)):
+            identity = pool.acquire()
+            if identity is None:
+                # everyone is resting, fail without a request
+                failed += 1
+                break
+            ok = extractor.extract(identity)
+            pool.release(identity, throttled=not ok)
+            if ok:
+                break
+        else:
+            failed += 1
+    print(f"{identity_count} identities: {failed}/{JOBS} jobs failed")
+    for line in pool.stats():
+        print("   ", line)
+    return failed
+
+
+if __name__ == "__main__":
+    for count in range(1, IDENTITIES + 1):
+        simulate(count)
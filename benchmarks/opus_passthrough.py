@@ -0,0 +1,60 @@
+"""
+Compares CPU spent per stream by the PCM path (decode, scale volume,
+encode) and by the opus passthrough path
+
+Usage: python -m benchmarks.opus_passthrough <opus webm url or file> [seconds]
+Needs a POSIX system to measure CPU time of FFmpeg
+"""
+
+import sys
+import time
+import resource
+
+from musicbot import sources
+from musicbot.linkutils import Origins, Sites
+from musicbot.songinfo import Song
+
+
+def children_cpu() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def measure(song: Song, passthrough: bool, seconds: float) -> float:
+    "Returns CPU seconds spent per minute of audio"
+    frames = int(seconds / sources.FRAME_LENGTH)
+    start_cpu = time.process_time()
+    start_children = children_cpu()
+
+    source = sources.PlaybackSource(
+        sources.open_track(song, passthrough=passthrough),
+        # volume != 1 makes the transformer do its work
+        0.5,
+    )
+    read = 0
+    while read < frames and source.read():
+        read += 1
+    source.cleanup()
+
+    cpu = time.process_time() - start_cpu + children_cpu() - start_children
+    audio = read * sources.FRAME_LENGTH
+    return cpu / audio * 60 if audio else float("nan")
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__.strip())
+        sys.exit(1)
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 60
+    song = Song(Origins.Default, Sites.Custom, base_url=sys.argv[1])
+    song.codec = "opus"
+
+    pcm = measure(song, False, seconds)
+    passthrough = measure(song, True, seconds)
+    print(f"PCM path:         {pcm:.3f} CPU s per audio minute")
+    print(f"passthrough path: {passthrough:.3f} CPU s per audio minute")
+    print(f"ratio: {pcm / passthrough:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
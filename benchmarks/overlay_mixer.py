@@ -0,0 +1,73 @@
+"""
+Measures CPU per frame of mixing overlays over the music
+with dsp.OverlayMixer on synthetic PCM data
+
+Usage: python -m benchmarks.overlay_mixer [frames]
+"""
+
+import sys
+import time
+import threading
+from collections import deque
+
+import numpy as np
+from discord.opus import Encoder
+
+from musicbot import dsp
+from benchmarks.pcm_volume import FakeFFmpeg
+
+OVERLAY_COUNTS = (0, 1, 2, 4, 8)
+
+
+def synthetic(frames: int, seed: int) -> bytes:
+    return (
+        np.random.default_rng(seed)
+        .integers(-20000, 20000, frames * Encoder.FRAME_SIZE // 2)
+        .astype(np.int16)
+        .tobytes()
+    )
+
+
+class ReadOverlay(dsp.BufferedOverlay):
+    "Overlay with all of its frames read ahead, leaves the reader out"
+
+    def __init__(self, data: bytes):
+        original = FakeFFmpeg(data)
+        self.original = original
+        self._frames = deque(iter(original.read, b""))
+        self._condition = threading.Condition()
+        self._done = True
+        self._stopped = False
+
+
+def measure(overlays: int, frames: int, music: bytes) -> float:
+    "Returns microseconds spent per frame"
+    track = dsp.PCMProcessor(FakeFFmpeg(music), 0.8)
+    mixer = dsp.OverlayMixer()
+    mixer.overlays = [
+        ReadOverlay(synthetic(frames, seed)) for seed in range(1, overlays + 1)
+    ]
+    start = time.perf_counter()
+    for _ in range(frames):
+        mixer.mix(track.read(), 0.8)
+    return (time.perf_counter() - start) / frames * 1e6
+
+
+def main():
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    music = synthetic(frames, 0)
+    baseline = None
+    for overlays in OVERLAY_COUNTS:
+        elapsed = measure(overlays, frames, music)
+        if baseline is None:
+            baseline = elapsed
+            print(f"{overlays} overlays: {elapsed:.1f} us per frame")
+        else:
+            print(
+                f"{overlays} overlays: {elapsed:.1f} us per frame,"
+                f" {(elapsed - baseline) / overlays:.1f} us per overlay"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Compares allocations and CPU per frame of discord.PCMVolumeTransformer
+and dsp.PCMProcessor on synthetic PCM data
+
+Usage: python -m benchmarks.pcm_volume [frames]
+"""
+
+import io
+import sys
+import time
+import tracemalloc
+
+import discord
+import numpy as np
+from discord.opus import Encoder
+
+from musicbot import dsp
+
+
+class FakeFFmpeg(discord.AudioSource):
+    "Stands in for FFmpegPCMAudio, reads from memory"
+
+    def __init__(self, data: bytes):
+        self._stdout = io.BufferedReader(io.BytesIO(data))
+
+    def read(self):
+        ret = self._stdout.read(Encoder.FRAME_SIZE)
+        if len(ret) != Encoder.FRAME_SIZE:
+            return b""
+        return ret
+
+
+def measure(name: str, source: discord.AudioSource, frames: int):
+    # warm up
+    source.read()
+
+    start = time.perf_counter()
+    for i in range(1, frames):
+        if i % 50 == 0:
+            # change volume every second to include ramps
+            source.volume = 0.3 if source.volume > 0.5 else 0.8
+        source.read()
+    elapsed = time.perf_counter() - start
+
+    # CPU and allocations are measured separately,
+    # tracing slows everything down
+    tracemalloc.start()
+    for _ in range(100):
+        source.read()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(
+        f"{name}: {elapsed / frames * 1e6:.1f} us per frame,"
+        f" {peak} bytes peak allocation while reading"
+    )
+
+
+def main():
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    # extra frames for the allocation measurement
+    total = frames + 101
+    data = (
+        np.random.default_rng(0)
+        .integers(-20000, 20000, total * Encoder.FRAME_SIZE // 2)
+        .astype(np.int16)
+        .tobytes()
+    )
+    measure(
+        "PCMVolumeTransformer",
+        discord.PCMVolumeTransformer(FakeFFmpeg(data), 0.8),
+        frames,
+    )
+    measure("PCMProcessor", dsp.PCMProcessor(FakeFFmpeg(data), 0.8), frames)
+    measure(
+        "PCMProcessor + limiter",
+        dsp.PCMProcessor(FakeFFmpeg(data), 0.8, [dsp.SoftLimiter()]),
+        frames,
+    )
+
+
+if __name__ == "__main__":
+    main()
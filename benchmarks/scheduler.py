@@ -0,0 +1,109 @@
+"""
+Compares frame deadline misses of pycord's player thread per stream
+and the shared audio scheduler as the number of streams grows,
+using fake sources that spend CPU time on every read
+
+Usage: python -m benchmarks.scheduler [seconds] [streams ...]
+"""
+
+import sys
+import time
+import asyncio
+import threading
+from typing import List
+
+import discord
+from discord.player import AudioPlayer
+
+from musicbot import scheduler
+
+# CPU time of reading a packet, holding the GIL like the volume code does
+READ_COST = 50e-6
+
+
+class FakeSource(discord.AudioSource):
+    def __init__(self, frames: int):
+        self.frames = frames
+
+    def is_opus(self) -> bool:
+        return True
+
+    def read(self) -> bytes:
+        if self.frames == 0:
+            return b""
+        self.frames -= 1
+        end = time.perf_counter() + READ_COST
+        while time.perf_counter() < end:
+            pass
+        return b"\xf8\xff\xfe"
+
+
+class FakeWebSocket:
+    async def speak(self, speaking: bool):
+        pass
+
+
+class FakeClient:
+    "Records when packets are sent instead of sending them"
+
+    loop = asyncio.new_event_loop()
+    ws = FakeWebSocket()
+
+    def __init__(self):
+        self._connected = threading.Event()
+        self._connected.set()
+        self.sent: List[float] = []
+        self.done = threading.Event()
+        self.buffer_stats = scheduler.BufferStats()
+
+    def send_audio_packet(self, data: bytes, encode: bool = True):
+        self.sent.append(time.perf_counter())
+
+
+def lateness(client: FakeClient) -> List[float]:
+    """Returns how late every packet was compared to a steady 20 ms pace
+    The pace is aligned to the median packet, players may start
+    with a different offset"""
+    offsets = [
+        sent - i * scheduler.DELAY for i, sent in enumerate(client.sent)
+    ]
+    median = sorted(offsets)[len(offsets) // 2]
+    return [offset - median for offset in offsets]
+
+
+def measure(name: str, streams: int, seconds: float):
+    frames = int(seconds / scheduler.DELAY)
+    clients = [FakeClient() for _ in range(streams)]
+    for client in clients:
+        source = FakeSource(frames)
+        after = lambda _, c=client: c.done.set()
+        if name == "threads":
+            AudioPlayer(source, client, after=after).start()
+        else:
+            player = scheduler.ScheduledPlayer(source, client, after=after)
+            scheduler.get_scheduler().add(player)
+    for client in clients:
+        client.done.wait()
+
+    late = sorted(x for c in clients for x in lateness(c))
+    # lateness is cumulative, count every packet over the threshold
+    misses = sum(x > scheduler.MISS_THRESHOLD for x in late)
+    p99 = late[int(len(late) * 0.99)]
+    print(
+        f"{name:>9} {streams:4} streams: {misses:6} of {len(late)}"
+        f" frames late, p99 {p99 * 1000:7.1f} ms"
+    )
+
+
+def main():
+    # players send speaking updates to the loop
+    threading.Thread(target=FakeClient.loop.run_forever, daemon=True).start()
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    counts = [int(n) for n in sys.argv[2:]] or [10, 50, 100, 200, 400]
+    for streams in counts:
+        measure("threads", streams, seconds)
+        measure("scheduler", streams, seconds)
+
+
+if __name__ == "__main__":
+    main()
@@ -69,6 +69,130 @@ class Config:
 
     COOKIE_PATH = "config/cookies/cookies.txt"
 
+    # kbps of the audio stream to pick
+    # when voice channel bitrate is unknown
+    DEFAULT_BITRATE = 64
+
+    # send opus streams without decoding them when volume is 100%
+    ENABLE_OPUS_PASSTHROUGH = False
+
+    # measure loudness of every played song once in the background
+    # and correct it on the next plays, songs that need correction
+    # can't use opus passthrough
+    NORMALIZE_LOUDNESS = False
+    # LUFS
+    TARGET_LOUDNESS = -16
+    # dB
+    MAX_LOUDNESS_BOOST = 6
+
+    # seconds before the end of a song to open the next one,
+    # so there's no gap between them
+    PREOPEN_TIME = 5
+    # seconds of crossfade between songs, 0 to switch without it,
+    # songs are decoded when enabled, even if they could use passthrough
+    CROSSFADE = 0.0
+
+    # megabytes of opus packets of fully played songs to keep on disk,
+    # replays at 100% volume read them instead of streaming, 0 disables
+    PACKET_CACHE_SIZE = 0
+    PACKET_CACHE_DIR = "packet_cache"
+
+    # stream songs through a local proxy that reads ahead
+    # and shares downloaded parts between guilds playing the same song
+    ENABLE_STREAM_PROXY = False
+    # megabytes to read ahead of FFmpeg
+    STREAM_READ_AHEAD = 2
+    # megabytes of downloaded parts to keep in memory
+    STREAM_CACHE_SIZE = 128
+    # seconds from the start of the next songs in the queue
+    # to download through the proxy before they play
+    PREFETCH_TIME = 10
+    # number of the next songs to download the start of, 0 disables
+    PREFETCH_SONGS = 2
+
+    # play all guilds on one thread sending packets every 20 ms
+    # instead of a thread per guild
+    ENABLE_AUDIO_SCHEDULER = False
+    # threads reading and encoding packets for the scheduler
+    AUDIO_READER_THREADS = 4
+    # packets encoded ahead of sending by the scheduler, covers pauses
+    # of the bot process up to 20 ms each, delays volume changes as much
+    AUDIO_BUFFER_FRAMES = 5
+
+    # processes decoding and encoding songs that can't use passthrough,
+    # so encoding uses more than one core, 0 encodes in the bot process,
+    # not used when CROSSFADE is enabled
+    ENCODER_PROCESSES = 0
+
+    # freeze objects loaded at startup, collect garbage less often
+    # and run full collections when no guild is playing,
+    # so collection pauses don't interrupt the audio
+    TUNE_GC = False
+    # gc.set_threshold() arguments of the young and middle generations
+    # used when TUNE_GC is enabled, full collections aren't automatic then
+    GC_THRESHOLDS = (10000, 50)
+    # seconds a full collection may wait for no guild to be playing
+    GC_MAX_DEFER = 600
+
+    # seconds of silence allowed for resuming a song
+    # whose stream broke in the middle
+    RECOVERY_TIMEOUT = 10
+
+    # set bitrate of the Opus encoder to the bitrate of the voice channel
+    # and lower its complexity and forward error correction to match,
+    # saves CPU time on songs that can't use opus passthrough
+    MATCH_CHANNEL_BITRATE = False
+
+    # lower encoding quality step by step while frames are sent late
+    # or the bot process is busy, raise it back once the load drops
+    ENABLE_QUALITY_GOVERNOR = False
+    # share of frames sent late by the audio scheduler
+    # that lowers the quality
+    GOVERNOR_MAX_LATE = 0.01
+    # share of a CPU core used by the bot process that lowers the quality
+    GOVERNOR_MAX_CPU = 0.8
+
+    # FFmpeg processes playing at once in all guilds, new songs wait
+    # for one to end, seeks and sound effects are counted but don't wait,
+    # 0 for no limit
+    MAX_FFMPEG_PROCESSES = 0
+
+    # directory of music files to play before searching YouTube,
+    # "$play" text queries matching their tags play the file directly,
+    # empty disables the library
+    LIBRARY_DIR = ""
+    # minutes between scans for new, modified and removed files
+    LIBRARY_SCAN_INTERVAL = 10
+
+    # filters applied to decoded audio, available: "limiter"
+    AUDIO_FILTERS = ()
+
+    # list of {"cookiefile": path, "player_client": name} objects
+    # to spread extraction between, COOKIE_PATH is used if empty
+    EXTRACTION_IDENTITIES = ()
+    # seconds to rest an identity after it gets throttled,
+    # doubles with every consecutive throttle
+    IDENTITY_COOLDOWN = 60
+
+    # how many search results to keep as fallbacks
+    # for videos that can't be played
+    SEARCH_CANDIDATES = 3
+
+    # seconds for loading songs to start playback,
+    # for user commands, for queue preloading and for warm-up
+    LOADER_TIMEOUTS = (20, 30, 60, 120)
+
+    # how many resolved songs to keep in memory
+    SONG_CACHE_SIZE = 500
+    # resolve most played tracks in the background after startup
+    ENABLE_CACHE_WARMUP = False
+    # days of play history to take into account
+    WARMUP_HISTORY_DAYS = 7
+    # how many tracks of every guild to resolve
+    WARMUP_TRACKS_PER_GUILD = 10
+    # maximum of tracks resolved in total
+    WARMUP_BUDGET = 100
+
     GLOBAL_DISABLE_AUTOJOIN_VC = False
 
     def __init__(self):
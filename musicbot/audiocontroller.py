@@ -1,13 +1,31 @@
 import sys
+import time
 import asyncio
+from collections import deque
 from itertools import islice
 from inspect import isawaitable
-from typing import TYPE_CHECKING, Coroutine, Optional
+from typing import TYPE_CHECKING, Coroutine, Deque, Optional, Tuple
 
 import discord
 from config import config
 
-from musicbot import linkutils, utils, loader
+from musicbot import (
+    broadcast,
+    encoding,
+    gctuning,
+    governor,
+    history,
+    linkutils,
+    loudness,
+    packetcache,
+    processes,
+    scheduler,
+    sources,
+    streamproxy,
+    utils,
+    voice,
+    loader,
+)
 from musicbot.playlist import Playlist, LoopMode, LoopState, PauseState
 from musicbot.songinfo import Song
 from musicbot.utils import CheckError, play_check
@@ -18,6 +36,12 @@ if TYPE_CHECKING:
 
 
 VC_TIMEOUT = 10
+# songs ending faster than this were most likely blocked
+BLOCKED_PLAYBACK_TIME = 3
+# how many gaps between songs to remember
+GAP_HISTORY = 100
+# times a song is resumed after its stream breaks
+MAX_RECOVERIES = 3
 _not_provided = object()
 
 
@@ -47,6 +71,7 @@ class AudioController(object):
         playlist: A Playlist object that stores the history and queue of songs.
         current_song: A Song object that stores details of the current song.
         guild: The guild in which the Audiocontroller operates.
+        transition_gaps: Seconds of silence between the last songs.
     """
 
     def __init__(self, bot: "MusicBot", guild: discord.Guild):
@@ -54,6 +79,20 @@ class AudioController(object):
         self.playlist = Playlist()
         self.current_song = None
         self._next_song = None
+        self._started_at = 0.0
+        self._interrupted = False
+        self._playback: Optional[sources.PlaybackSource] = None
+        self._preopen_task: Optional[asyncio.Task] = None
+        # time of the last frame of the song that ended by itself
+        self._transition_from: Optional[float] = None
+        self.transition_gaps: Deque[float] = deque(maxlen=GAP_HISTORY)
+        # seconds from seeking or switching the track to its first frame
+        self.restart_latencies: Deque[float] = deque(maxlen=GAP_HISTORY)
+        # streams that broke in the middle and how many were resumed
+        self.broken_streams = 0
+        self.recovered_streams = 0
+        self.recovery_latencies: Deque[float] = deque(maxlen=GAP_HISTORY)
+        self._recoveries_left = MAX_RECOVERIES
         self.guild = guild
 
         sett = bot.settings[guild]
@@ -79,10 +118,17 @@ class AudioController(object):
     @volume.setter
     def volume(self, value: int):
         self._volume = value
-        try:
-            self.guild.voice_client.source.volume = float(value) / 100.0
-        except Exception:
-            pass
+        playback = self._playback
+        if playback is None or not self.is_active():
+            return
+        if (
+            playback.passthrough
+            and value != 100
+            and not governor.forces_passthrough()
+        ):
+            # opus packets can't be scaled, decode the rest of the song
+            self.add_task(self._decode(playback))
+        playback.volume = float(value) / 100.0
 
     def volume_up(self):
         self.volume = min(self.volume + 10, 100)
@@ -90,6 +136,34 @@ class AudioController(object):
     def volume_down(self):
         self.volume = max(self.volume - 10, 10)
 
+    def target_bitrate(self) -> Optional[int]:
+        "Bitrate of the voice channel in kbps"
+        client = self.guild.voice_client
+        if client is None:
+            return None
+        return client.channel.bitrate // 1000
+
+    def encoder_settings(self) -> Optional[encoding.EncoderSettings]:
+        "Encoder settings for the voice channel and the quality level"
+        return governor.limit(encoding.settings_for(self.target_bitrate()))
+
+    def update_encoder(self):
+        "Matches the encoder of the current song to the voice channel"
+        if self._playback:
+            self._playback.encoder_settings = self.encoder_settings()
+
+    def apply_quality(self):
+        "Follows the quality level set by the governor"
+        self.update_encoder()
+        playback = self._playback
+        if playback is None or not self.is_active():
+            return
+        if governor.forces_passthrough():
+            if not playback.passthrough:
+                self.add_task(self._pass_through(playback))
+        elif playback.passthrough and not self._is_unity(playback.gain):
+            self.add_task(self._decode(playback))
+
     async def register_voice_channel(self, channel: discord.VoiceChannel):
         perms = channel.permissions_for(self.guild.me)
         if not perms.connect or not perms.speak:
@@ -97,11 +171,18 @@ class AudioController(object):
 
         bot_vc = self.guild.voice_client
         if bot_vc:
+            # the player keeps its source while the connection is replaced
             await bot_vc.move_to(channel)
-            # to avoid ClientException: Not connected to voice
-            await asyncio.sleep(1)
         else:
-            await channel.connect(reconnect=True, timeout=VC_TIMEOUT)
+            await channel.connect(
+                reconnect=True,
+                timeout=VC_TIMEOUT,
+                cls=(
+                    scheduler.ScheduledVoiceClient
+                    if config.ENABLE_AUDIO_SCHEDULER
+                    else voice.VoiceClient
+                ),
+            )
 
     def make_view(self):
         if not self.is_active():
@@ -275,12 +356,26 @@ class AudioController(object):
 
         if self.is_active():
             self._next_song = self.playlist.next(forced)
-            self.guild.voice_client.stop()
+            self._stop()
             return
 
         if self.current_song:
-            self.playlist.add_name(self.current_song.info.title)
+            song = self.current_song
             self.current_song = None
+            if (
+                not self._interrupted
+                and self._was_blocked(song)
+                and song.promote_alternate()
+            ):
+                # try the next search result instead
+                self.add_task(self.play_song(song))
+                return
+            self.playlist.add_name(song.info.title)
+            if not self._interrupted and self._playback:
+                self._transition_from = self._playback.last_frame_at
+
+        # this guild is silent until the next song starts
+        gctuning.collect_if_idle(self.bot)
 
         if self._next_song:
             next_song = self._next_song
@@ -303,12 +398,101 @@ class AudioController(object):
         coro = self.play_song(next_song)
         self.add_task(coro)
 
+    def _was_blocked(self, song: Song) -> bool:
+        "Checks if the song stopped playing right after start"
+        played = time.monotonic() - self._started_at
+        return played < BLOCKED_PLAYBACK_TIME and (
+            song.info.duration is None
+            or song.info.duration > BLOCKED_PLAYBACK_TIME
+        )
+
+    def _stop(self):
+        "Stops the current song on purpose"
+        self._interrupted = True
+        self.guild.voice_client.stop()
+
     async def play_song(self, song: Song):
         """Plays a song object"""
 
-        if not await loader.preload(song):
+        opened = await self._open_song(song)
+        if opened is None:
             self.next_song(forced=True)
             return
+        track, gain, recorder = opened
+
+        self.current_song = song
+        self._started_at = time.monotonic()
+        self._interrupted = False
+
+        self._playback = sources.PlaybackSource(
+            track,
+            float(self.volume) / 100.0,
+            gain=gain,
+            gaps=self.transition_gaps,
+            restarts=self.restart_latencies,
+            previous_frame_at=self._transition_from,
+            on_switch=self._on_switch,
+            recorder=recorder,
+            duration=song.info.duration,
+            on_broken=self._on_broken,
+            encoder_settings=self.encoder_settings(),
+        )
+        self._transition_from = None
+        voice_client = self.guild.voice_client
+        try:
+            # to avoid ClientException: Not connected to voice after a move
+            connected = voice_client and await voice_client.wait_connected(
+                VC_TIMEOUT
+            )
+            if connected:
+                voice_client.play(self._playback, after=self.next_song)
+        except BaseException:
+            # a broadcast keeps running while it has listeners
+            self._drop_playback()
+            raise
+        if not connected:
+            # did not reconnect, clear state
+            self._drop_playback()
+            await self.udisconnect()
+            return
+        await self._song_started(song)
+
+    def _drop_playback(self):
+        "Cleans up the playback that didn't start"
+        self._playback.cleanup()
+        self._playback = None
+        self.current_song = None
+
+    def _is_unity(self, gain: float) -> bool:
+        "Checks if the song can be played without changing its packets"
+        return self.volume == 100 and gain == 1.0 and not config.CROSSFADE
+
+    async def _open_song(
+        self, song: Song, preopen: bool = False
+    ) -> Optional[
+        Tuple[discord.AudioSource, float, Optional[packetcache.Recorder]]
+    ]:
+        """Opens the song from the packet cache or with FFmpeg
+        Returns the track, its gain and recorder for the packet cache
+        Errors of preopened songs are told once they should play"""
+        if self._is_unity(loudness.gain(song)) and not song.broadcast:
+            cached = packetcache.get(song)
+            if cached:
+                return cached, 1.0, None
+
+        try:
+            preloaded = await loader.preload(
+                song, loader.Priority.PLAYBACK, self.target_bitrate()
+            )
+        except loader.SongError as e:
+            if preopen:
+                print("Failed to preopen the next song:", e, file=sys.stderr)
+            # the song is skipped, tell why
+            elif self.command_channel:
+                await self.command_channel.send(e)
+            return None
+        if not preloaded:
+            return None
 
         if song.base_url is None:
             print(
@@ -316,26 +500,236 @@ class AudioController(object):
                 " Refusing to play a song without base_url.",
                 file=sys.stderr,
             )
-            self.next_song(forced=True)
-            return
+            return None
 
-        self.current_song = song
+        if song.broadcast:
+            return broadcast.listen(song), 1.0, None
+
+        await processes.admit()
+        # webpage url could change while loading
+        gain = loudness.gain(song)
+        unity = self._is_unity(gain)
+        track = sources.open_track(
+            song,
+            passthrough=(unity or governor.forces_passthrough())
+            and sources.can_passthrough(song),
+            guild_id=self.guild.id,
+        )
+        return track, gain, packetcache.recorder(song) if unity else None
+
+    async def _decode(self, playback: sources.PlaybackSource):
+        "Replaces opus track of the current song with decoded one"
+        song = self.current_song
+        try:
+            preloaded = await loader.preload(
+                song, loader.Priority.PLAYBACK, self.target_bitrate()
+            )
+        except loader.SongError:
+            return
+        if (
+            not preloaded
+            or song.base_url is None
+            or song is not self.current_song
+            or playback is not self._playback
+            or not playback.passthrough
+            # shared packets can't follow the volume
+            or song.broadcast
+            or governor.forces_passthrough()
+        ):
+            return
+        position = playback.position
+        playback.replace(
+            sources.open_track(song, start=position, guild_id=self.guild.id),
+            position,
+        )
 
-        self.guild.voice_client.play(
-            discord.FFmpegPCMAudio(
-                song.base_url,
-                before_options="-reconnect 1 -reconnect_streamed 1"
-                " -reconnect_delay_max 5",
-                options="-loglevel error",
-                stderr=sys.stderr,
+    async def _pass_through(self, playback: sources.PlaybackSource):
+        """Replaces decoded track of the current song with its opus packets
+        Saves CPU time, volume and loudness correction are lost"""
+        song = self.current_song
+        if song is None or not sources.can_passthrough(song):
+            return
+        try:
+            preloaded = await loader.preload(
+                song, loader.Priority.PLAYBACK, self.target_bitrate()
+            )
+        except loader.SongError:
+            return
+        if (
+            not preloaded
+            or song.base_url is None
+            or song is not self.current_song
+            or playback is not self._playback
+            or playback.passthrough
+            or song.broadcast
+            or not governor.forces_passthrough()
+        ):
+            return
+        position = playback.position
+        playback.replace(
+            sources.open_track(
+                song,
+                passthrough=True,
+                start=position,
+                guild_id=self.guild.id,
             ),
-            after=self.next_song,
+            position,
+        )
+
+    @property
+    def position(self) -> Optional[float]:
+        "Seconds of the current song sent so far, None if nothing plays"
+        playback = self._playback
+        if playback is None or self.current_song is None:
+            return None
+        # packets buffered by the scheduler weren't heard yet
+        buffered = getattr(self.guild.voice_client, "buffered", 0)
+        return max(playback.position - buffered * sources.FRAME_LENGTH, 0.0)
+
+    def seek(self, position: float) -> bool:
+        """Continues the current song from the position in seconds
+        Reuses the resolved url, returns False if the song can't seek"""
+        song = self.current_song
+        playback = self._playback
+        if (
+            song is None
+            or playback is None
+            # everyone hears the same position
+            or song.broadcast
+        ):
+            return False
+        track = None
+        if isinstance(playback.track, packetcache.CachedOpusAudio):
+            track = packetcache.get(song)
+            if track:
+                track.skip(int(position / sources.FRAME_LENGTH))
+        if track is None:
+            if song.base_url is None:
+                return False
+            track = sources.open_track(
+                song,
+                passthrough=playback.passthrough
+                and sources.can_passthrough(song),
+                start=position,
+                guild_id=self.guild.id,
+            )
+        playback.dequeue()
+        playback.replace(track, position)
+        self._schedule_preopen(song)
+        return True
+
+    def play_effect(self, url: str) -> bool:
+        "Plays the audio file over the current song"
+        playback = self._playback
+        if playback is None or self.current_song is None:
+            return False
+        overlay = sources.open_overlay(url, self.guild.id)
+        if not playback.add_overlay(overlay):
+            overlay.cleanup()
+            return False
+        return True
+
+    def _on_broken(self, position: float):
+        "Called by the player thread when the stream ends too early"
+        playback = self._playback
+        self.bot.loop.call_soon_threadsafe(
+            lambda: self.add_task(self._recover(playback, position))
         )
 
-        self.guild.voice_client.source = discord.PCMVolumeTransformer(
-            self.guild.voice_client.source
+    async def _recover(
+        self, playback: sources.PlaybackSource, position: float
+    ):
+        "Resumes the song at the position from a new stream"
+        song = self.current_song
+        if (
+            song is None
+            or playback is not self._playback
+            # joined live, it didn't play from the start
+            or song.broadcast
+            # most likely blocked, next_song() tries another search result
+            or position < BLOCKED_PLAYBACK_TIME
+            or self._recoveries_left == 0
+        ):
+            playback.abandon_recovery()
+            return
+        self._recoveries_left -= 1
+        self.broken_streams += 1
+        started = time.perf_counter()
+        try:
+            track = await asyncio.wait_for(
+                self._reopen(song, position, playback.passthrough),
+                config.RECOVERY_TIMEOUT,
+            )
+        except (asyncio.TimeoutError, loader.SongError):
+            track = None
+        except Exception as e:
+            print("Failed to recover the stream:", e, file=sys.stderr)
+            track = None
+        if (
+            track is None
+            or playback is not self._playback
+            or song is not self.current_song
+        ):
+            if track:
+                track.cleanup()
+            playback.abandon_recovery()
+            return
+        playback.replace(track, position)
+        self.recovered_streams += 1
+        self.recovery_latencies.append(time.perf_counter() - started)
+
+    async def _reopen(
+        self, song: Song, position: float, passthrough: bool
+    ) -> Optional[discord.AudioSource]:
+        """Opens the song at the position from another format,
+        or resolves it again if the url expired"""
+        if not (loader.is_fresh(song) and song.promote_format()):
+            if not await loader.preload(
+                song,
+                loader.Priority.PLAYBACK,
+                self.target_bitrate(),
+                refresh=True,
+            ):
+                return None
+        return sources.open_track(
+            song,
+            passthrough=passthrough and sources.can_passthrough(song),
+            start=position,
+            guild_id=self.guild.id,
         )
-        self.guild.voice_client.source.volume = float(self.volume) / 100.0
+
+    def _on_switch(self, song: Song):
+        "Called by the player thread when the queued song starts"
+        self.bot.loop.call_soon_threadsafe(self._track_switched, song)
+
+    def _track_switched(self, song: Song):
+        "Does the bookkeeping of next_song() for the queued song"
+        if not self.is_active():
+            return
+        if self.current_song:
+            self.playlist.add_name(self.current_song.info.title)
+        expected = self.playlist.next()
+        self._started_at = time.monotonic()
+        self._interrupted = False
+        if expected is not song:
+            # the queue has changed after the song was opened
+            self.current_song = None
+            self._next_song = expected
+            self._stop()
+            return
+
+        self.current_song = song
+        # passthrough songs don't follow volume changes
+        self.volume = self._volume
+        self.add_task(self._song_started(song))
+
+    async def _song_started(self, song: Song):
+        self._recoveries_left = MAX_RECOVERIES
+        self._schedule_preopen(song)
+        self.add_task(loudness.analyze(self.bot, song))
+
+        if config.ENABLE_CACHE_WARMUP and song.host != linkutils.Sites.Custom:
+            self.add_task(history.record_play(self.bot, self.guild, song))
 
         if (
             self.bot.settings[self.guild].announce_songs
@@ -347,17 +741,118 @@ class AudioController(object):
 
         self.preload_queue()
 
-    async def process_song(self, track: str) -> Optional[Song]:
+    def _schedule_preopen(self, song: Song):
+        if self._preopen_task:
+            self._preopen_task.cancel()
+        self._preopen_task = self.add_task(
+            self._preopen(self._playback, song)
+        )
+
+    async def _preopen(self, playback: sources.PlaybackSource, song: Song):
+        "Opens the next song shortly before the current one ends"
+        duration = song.info.duration
+        if not duration:
+            return
+        lead = config.PREOPEN_TIME + config.CROSSFADE
+        while True:
+            delay = duration - playback.position - lead
+            if delay <= 0:
+                break
+            # position doesn't move while paused, check again after sleep
+            await asyncio.sleep(delay)
+            if playback is not self._playback or not self.is_active():
+                return
+
+        next_song = self.playlist.peek_next()
+        # listening starts the real-time producer of a broadcast,
+        # the song would start seconds in when the current one ends
+        if next_song is None or next_song.broadcast:
+            return
+        opened = await self._open_song(next_song, preopen=True)
+        if opened is None:
+            return
+        track, gain, recorder = opened
+        if playback is not self._playback or not self.is_active():
+            track.cleanup()
+            if recorder:
+                recorder.abort()
+            return
+
+        playback.queue(
+            track,
+            next_song,
+            gain,
+            fade_at=duration - config.CROSSFADE if config.CROSSFADE else None,
+            recorder=recorder,
+        )
+
+    def transition_stats(self) -> Optional[str]:
+        "Describes gaps between songs, None if there were no transitions"
+        if not self.transition_gaps:
+            return None
+        gaps = sorted(self.transition_gaps)
+        return "{} transitions, median gap {:.0f} ms, max {:.0f} ms".format(
+            len(gaps), gaps[len(gaps) // 2] * 1000, gaps[-1] * 1000
+        )
+
+    def recovery_stats(self) -> Optional[str]:
+        "Describes recoveries of broken streams, None if none broke"
+        if not self.broken_streams:
+            return None
+        latencies = sorted(self.recovery_latencies)
+        return "{} of {} broken streams recovered{}".format(
+            self.recovered_streams,
+            self.broken_streams,
+            ", median latency {:.0f} ms".format(
+                latencies[len(latencies) // 2] * 1000
+            )
+            if latencies
+            else "",
+        )
+
+    def restart_stats(self) -> Optional[str]:
+        "Describes latency of seeks and track switches, None if none"
+        if not self.restart_latencies:
+            return None
+        latencies = sorted(self.restart_latencies)
+        return "{} restarts, median latency {:.0f} ms, max {:.0f} ms".format(
+            len(latencies),
+            latencies[len(latencies) // 2] * 1000,
+            latencies[-1] * 1000,
+        )
+
+    def buffer_stats(self) -> Optional[str]:
+        "Describes the jitter buffer, None if the scheduler isn't used"
+        stats = getattr(self.guild.voice_client, "buffer_stats", None)
+        if not stats or not stats.frames:
+            return None
+        return str(stats)
+
+    def reconnect_stats(self) -> Optional[str]:
+        "Describes reconnects of the voice client, None if it had none"
+        client = self.guild.voice_client
+        if not client or not client.reconnect_stats.reconnects:
+            return None
+        return str(client.reconnect_stats)
+
+    async def process_song(
+        self, track: str, broadcast: bool = False
+    ) -> Optional[Song]:
         """Adds the track to the playlist instance
-        Starts playing if it is the first song"""
+        Starts playing if it is the first song
+        Broadcast songs are played in sync with other guilds"""
 
-        loaded_song = await loader.load_song(track)
+        loaded_song = await loader.load_song(
+            track, bitrate=self.target_bitrate()
+        )
         if not loaded_song:
             return None
         elif isinstance(loaded_song, Song):
+            loaded_song.broadcast = broadcast
             self.playlist.add(loaded_song)
         else:
             for song in loaded_song:
+                song.broadcast = broadcast
                 self.playlist.add(song)
             loaded_song = Song(
                 linkutils.Origins.Playlist, linkutils.Sites.Unknown
@@ -369,17 +864,27 @@ class AudioController(object):
 
         return loaded_song
 
-    def add_task(self, coro: Coroutine):
+    def add_task(self, coro: Coroutine) -> asyncio.Task:
         task = self.bot.loop.create_task(coro)
         self._tasks.add(task)
         task.add_done_callback(lambda t: self._tasks.remove(t))
+        return task
 
     async def _preload_queue(self):
         rerun_needed = False
-        for song in list(
-            islice(self.playlist.playque, 1, config.MAX_SONG_PRELOAD)
+        for position, song in enumerate(
+            list(islice(self.playlist.playque, 1, config.MAX_SONG_PRELOAD))
         ):
-            if not await loader.preload(song):
+            try:
+                preloaded = await loader.preload(
+                    song, bitrate=self.target_bitrate()
+                )
+            except loader.SongError:
+                # may be loaded later with higher priority
+                continue
+            if preloaded and position < config.PREFETCH_SONGS:
+                self.add_task(streamproxy.prefetch(song))
+            if not preloaded:
                 try:
                     self.playlist.playque.remove(song)
                     rerun_needed = True
@@ -402,7 +907,7 @@ class AudioController(object):
         if not self.is_active():
             return
 
-        self.guild.voice_client.stop()
+        self._stop()
 
     def prev_song(self) -> bool:
         """Loads the last song from the history into the queue and starts it"""
@@ -415,7 +920,7 @@ class AudioController(object):
             self.add_task(self.play_song(prev_song))
         else:
             self._next_song = prev_song
-            self.guild.voice_client.stop()
+            self._stop()
         return True
 
     async def timeout_handler(self):
@@ -1,5 +1,6 @@
 import sys
 import asyncio
+from itertools import zip_longest
 from traceback import print_exception
 from typing import Dict, Union, List
 
@@ -11,6 +12,17 @@ from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
 
 from config import config
+from musicbot import (
+    gctuning,
+    governor,
+    history,
+    library,
+    loader,
+    loudness,
+    packetcache,
+    processes,
+    streamproxy,
+)
 from musicbot.audiocontroller import VC_TIMEOUT, AudioController
 from musicbot.settings import (
     GuildSettings,
@@ -41,18 +53,30 @@ class MusicBot(bridge.Bot):
         self.add_bridge_command(self._help)
 
         self.absolutely_ready = asyncio.Future()
+        self._warmup_task = None
 
     async def start(self, *args, **kwargs):
         print(config.STARTUP_MESSAGE)
+        gctuning.install()
 
         async with self.db_engine.connect() as connection:
             await connection.run_sync(run_migrations)
         await extract_legacy_settings(self)
+        if config.NORMALIZE_LOUDNESS:
+            await loudness.load(self)
+        if config.PACKET_CACHE_SIZE:
+            packetcache.load()
+        if config.LIBRARY_DIR:
+            await library.load(self)
+        if config.ENABLE_STREAM_PROXY:
+            await streamproxy.start()
+        gctuning.freeze()
         return await super().start(*args, **kwargs)
 
     async def close(self):
         for audiocontroller in self.audio_controllers.values():
             await audiocontroller.udisconnect()
+        await streamproxy.stop()
         return await super().close()
 
     async def on_ready(self):
@@ -66,10 +90,55 @@ class MusicBot(bridge.Bot):
 
         if not self.update_views.is_running():
             self.update_views.start()
+        if not self.reap_processes.is_running():
+            self.reap_processes.start()
+        # guilds and members are cached now
+        gctuning.freeze()
+        if config.TUNE_GC and not self.collect_garbage.is_running():
+            self.collect_garbage.start()
+        if (
+            config.ENABLE_QUALITY_GOVERNOR
+            and not self.govern_quality.is_running()
+        ):
+            self.govern_quality.start()
+
+        if config.LIBRARY_DIR and not self.scan_library.is_running():
+            self.scan_library.start()
+
+        if config.ENABLE_CACHE_WARMUP and self._warmup_task is None:
+            self._warmup_task = self.loop.create_task(self.warm_up_cache())
 
         if not self.absolutely_ready.done():
             self.absolutely_ready.set_result(True)
 
+    async def warm_up_cache(self):
+        "Resolves the most played tracks of recent history in the background"
+        await history.prune(self)
+        guild_ids = {str(guild.id) for guild in self.guilds}
+        popular = [
+            requests
+            for guild_id, requests in (
+                await history.most_played(
+                    self, config.WARMUP_TRACKS_PER_GUILD
+                )
+            ).items()
+            if guild_id in guild_ids
+        ]
+
+        tracks = []
+        # take tracks from every guild in turn
+        # so that each guild gets its favourites resolved
+        for batch in zip_longest(*popular):
+            for track in batch:
+                if track is not None and track not in tracks:
+                    tracks.append(track)
+
+        for track in tracks[: config.WARMUP_BUDGET]:
+            try:
+                await loader.load_song(track, loader.Priority.WARMUP)
+            except Exception as e:
+                print(f"Failed to warm up {track}:", e, file=sys.stderr)
+
     async def on_guild_join(self, guild):
         print(guild.name)
         await self.register(guild)
@@ -86,18 +155,18 @@ class MusicBot(bridge.Bot):
         guild = member.guild
         if member == self.user:
             audiocontroller = self.audio_controllers[guild]
-            if not guild.voice_client:
-                await asyncio.sleep(VC_TIMEOUT)
-            if guild.voice_client:
-                is_playing = guild.voice_client.is_playing()
-                await audiocontroller.timer.start(is_playing)
-                if is_playing:
-                    # bot was moved, restore playback
-                    await asyncio.sleep(1)
-                    guild.voice_client.resume()
-            else:
+            voice_client = guild.voice_client
+            # moves and reconnects keep the voice client and its player,
+            # the client resumes playback by itself
+            if not voice_client or not await voice_client.wait_connected(
+                VC_TIMEOUT
+            ):
                 # did not reconnect, clear state
                 await audiocontroller.udisconnect()
+                return
+            # the new channel may have another bitrate
+            audiocontroller.update_encoder()
+            await audiocontroller.timer.start(voice_client.is_playing())
         elif (
             guild.voice_client
             and guild.voice_client.channel == before.channel
@@ -107,11 +176,36 @@ class MusicBot(bridge.Bot):
             audiocontroller = self.audio_controllers[guild]
             await audiocontroller.timer.start(guild.voice_client.is_playing())
 
+    async def on_guild_channel_update(self, before, after):
+        voice_client = after.guild.voice_client
+        if (
+            voice_client
+            and voice_client.channel == after
+            and before.bitrate != after.bitrate
+        ):
+            self.audio_controllers[after.guild].update_encoder()
+
     @tasks.loop(seconds=1)
     async def update_views(self):
         for audiocontroller in self.audio_controllers.values():
             await audiocontroller.update_view()
 
+    @tasks.loop(seconds=30)
+    async def collect_garbage(self):
+        gctuning.collect_if_idle(self)
+
+    @tasks.loop(seconds=governor.CHECK_INTERVAL)
+    async def govern_quality(self):
+        await governor.check(self)
+
+    @tasks.loop(seconds=10)
+    async def reap_processes(self):
+        await processes.reap(self)
+
+    @tasks.loop(minutes=config.LIBRARY_SCAN_INTERVAL)
+    async def scan_library(self):
+        await library.scan(self)
+
     def add_application_command(self, command):
         if not config.ENABLE_SLASH_COMMANDS:
             return
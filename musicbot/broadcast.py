@@ -0,0 +1,141 @@
+import time
+import threading
+from collections import deque
+from typing import Deque, Dict, Optional
+
+import discord
+
+from musicbot import sources
+from musicbot.songinfo import Song
+
+# packets kept for listeners that are a bit behind
+BUFFER_PACKETS = 50
+
+_broadcasts: Dict[str, "Broadcast"] = {}
+# listeners leave from player threads
+_lock = threading.Lock()
+
+
+class Broadcast:
+    """Plays one song in real time for any number of listeners
+    The song is decoded and encoded once, listeners share the packets
+
+    Attributes:
+        key: Identifies the song being broadcast.
+        sequence: Number of packets produced so far.
+        ended: Set when the song has ended.
+    """
+
+    def __init__(self, key: str, song: Song):
+        self.key = key
+        self.sequence = 0
+        self.ended = False
+        self.listeners = 0
+        self._packets: Deque[bytes] = deque(maxlen=BUFFER_PACKETS)
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._source = sources.PlaybackSource(
+            sources.open_track(
+                song, passthrough=sources.can_passthrough(song)
+            ),
+            1.0,
+        )
+        self._thread = threading.Thread(
+            target=self._run, name=f"broadcast {key}", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self):
+        start = time.perf_counter()
+        try:
+            while not self._stopped.is_set():
+                packet = self._source.read()
+                with self._lock:
+                    if packet:
+                        self._packets.append(packet)
+                        self.sequence += 1
+                    else:
+                        self.ended = True
+                if not packet:
+                    break
+                delay = (
+                    start
+                    + self.sequence * sources.FRAME_LENGTH
+                    - time.perf_counter()
+                )
+                self._stopped.wait(max(delay, 0))
+        finally:
+            with self._lock:
+                self.ended = True
+            self._source.cleanup()
+
+    def packet(self, sequence: int) -> Optional[bytes]:
+        """Returns the packet with the sequence number, silence if it's
+        not produced yet, None if it's not kept anymore,
+        b"" if the broadcast ended"""
+        with self._lock:
+            if sequence >= self.sequence:
+                return b"" if self.ended else sources.OPUS_SILENCE
+            oldest = self.sequence - len(self._packets)
+            if sequence < oldest:
+                return None
+            return self._packets[sequence - oldest]
+
+    def stop(self):
+        self._stopped.set()
+
+
+class Listener(discord.AudioSource):
+    "Plays packets of a broadcast starting from the live position"
+
+    def __init__(self, broadcast: Broadcast):
+        self.broadcast = broadcast
+        self._sequence: Optional[int] = None
+        self._left = False
+
+    def is_opus(self) -> bool:
+        return True
+
+    def read(self) -> bytes:
+        if self._left:
+            return b""
+        broadcast = self.broadcast
+        if self._sequence is None:
+            # join live when the playback starts, not when opened
+            self._sequence = broadcast.sequence
+        packet = broadcast.packet(self._sequence)
+        if packet is None:
+            # fell too far behind, catch up
+            self._sequence = broadcast.sequence
+            packet = broadcast.packet(self._sequence)
+        if packet and packet is not sources.OPUS_SILENCE:
+            self._sequence += 1
+        return packet
+
+    def cleanup(self):
+        if self._left:
+            return
+        self._left = True
+        with _lock:
+            self.broadcast.listeners -= 1
+            if self.broadcast.listeners == 0:
+                self.broadcast.stop()
+                if _broadcasts.get(self.broadcast.key) is self.broadcast:
+                    del _broadcasts[self.broadcast.key]
+
+
+def listen(song: Song) -> Listener:
+    "Joins the broadcast of the song, starting it if needed"
+    key = song.info.webpage_url or song.base_url
+    with _lock:
+        broadcast = _broadcasts.get(key)
+        if broadcast is None or broadcast.ended:
+            broadcast = _broadcasts[key] = Broadcast(key, song)
+        broadcast.listeners += 1
+    return Listener(broadcast)
+
+
+def stats() -> Dict[str, int]:
+    "Returns number of listeners by broadcast key"
+    with _lock:
+        return {key: b.listeners for key, b in _broadcasts.items()}
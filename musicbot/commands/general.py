@@ -5,6 +5,15 @@ import discord
 from discord.ext import commands, bridge
 
 from config import config
+from musicbot import (
+    broadcast,
+    encoding,
+    gctuning,
+    governor,
+    loader,
+    processes,
+    scheduler,
+)
 from musicbot.bot import Context, MusicBot
 from musicbot.settings import CONFIG_OPTIONS, ConversionError
 from musicbot.audiocontroller import AudioController
@@ -90,6 +99,51 @@ class General(commands.Cog):
         sys.excepthook = lambda *_: None
         sys.exit()
 
+    @commands.command(
+        name="stats",
+        hidden=True,
+    )
+    @commands.is_owner()
+    async def _stats(self, ctx: Context):
+        lines = []
+        for guild, audiocontroller in ctx.bot.audio_controllers.items():
+            transitions = audiocontroller.transition_stats()
+            if transitions:
+                lines.append(f"{guild.name}: {transitions}")
+            recoveries = audiocontroller.recovery_stats()
+            if recoveries:
+                lines.append(f"{guild.name}: {recoveries}")
+            restarts = audiocontroller.restart_stats()
+            if restarts:
+                lines.append(f"{guild.name}: {restarts}")
+            buffer = audiocontroller.buffer_stats()
+            if buffer:
+                lines.append(f"{guild.name}: {buffer}")
+            reconnects = audiocontroller.reconnect_stats()
+            if reconnects:
+                lines.append(f"{guild.name}: {reconnects}")
+            ffmpeg = processes.guild_stats(guild.id)
+            if ffmpeg:
+                lines.append(f"{guild.name}: {ffmpeg}")
+        for key, listeners in broadcast.stats().items():
+            lines.append(f"Broadcast {key}: {listeners} listeners")
+        scheduled = scheduler.stats()
+        if scheduled:
+            lines.append(f"Scheduler: {scheduled}")
+        encoders = encoding.stats()
+        if encoders:
+            lines.append(f"Encoding: {encoders}")
+        lines.append(f"FFmpeg: {processes.stats()}")
+        loading = loader.stats()
+        if loading:
+            lines.append(f"Loader: {loading}")
+        for identity in loader.identity_pool.stats():
+            lines.append(f"Identity {identity}")
+        if config.ENABLE_QUALITY_GOVERNOR:
+            lines.append(f"Quality: {governor.stats()}")
+        lines.append(f"GC: {gctuning.stats()}")
+        await ctx.send("\n".join(lines))
+
     @bridge.bridge_group(
         name="setting",
         description=config.HELP_SETTINGS_LONG,
@@ -1,3 +1,6 @@
+import math
+import datetime
+
 from discord import Option, Attachment
 from discord.ext import commands, bridge
 
@@ -20,6 +23,21 @@ def active_only(ctx: AudioContext):
     return True
 
 
+def parse_time(text: str) -> float:
+    """Converts [[hours:]minutes:]seconds to seconds
+    Raises ValueError for parts that are negative or not finite"""
+    seconds = 0.0
+    for part in text.split(":"):
+        value = float(part)
+        if not math.isfinite(value) or value < 0:
+            raise ValueError(text)
+        seconds = seconds * 60 + value
+    # it's shown as a timedelta
+    if seconds > datetime.timedelta.max.total_seconds():
+        raise ValueError(text)
+    return seconds
+
+
 class Music(commands.Cog):
     """A collection of the commands related to music playback.
 
@@ -54,13 +72,26 @@ class Music(commands.Cog):
             await ctx.send(config.PLAY_ARGS_MISSING)
             return
 
+        await self._queue_track(ctx, track)
+
+    @bridge.bridge_command(
+        name="radio",
+        description=config.HELP_RADIO_LONG,
+        help=config.HELP_RADIO_SHORT,
+    )
+    async def _radio(self, ctx: AudioContext, *, track: str):
+        await self._queue_track(ctx, track, broadcast=True)
+
+    async def _queue_track(
+        self, ctx: AudioContext, track: str, broadcast: bool = False
+    ):
         await ctx.defer()
 
         # reset timer
         await ctx.audiocontroller.timer.start(True)
 
         try:
-            song = await ctx.audiocontroller.process_song(track)
+            song = await ctx.audiocontroller.process_song(track, broadcast)
         except SongError as e:
             await ctx.send(e)
             return
@@ -192,6 +223,57 @@ class Music(commands.Cog):
         ctx.audiocontroller.next_song(forced=True)
         await ctx.send("Skipped current song :fast_forward:")
 
+    @bridge.bridge_command(
+        name="effect",
+        description=config.HELP_EFFECT_LONG,
+        help=config.HELP_EFFECT_SHORT,
+        aliases=["sfx"],
+    )
+    @active_only
+    async def _effect(
+        self, ctx: AudioContext, url: str = None, file: Attachment = None
+    ):
+        if ctx.message and ctx.message.attachments:
+            file = ctx.message.attachments[0]
+        if file is not None:
+            url = file.url
+        if (
+            url is None
+            or linkutils.identify_url(url) != linkutils.Sites.Custom
+        ):
+            await ctx.send(config.EFFECT_ARGS_INVALID)
+            return
+        if not ctx.audiocontroller.play_effect(url):
+            await ctx.send(config.EFFECT_UNAVAILABLE)
+            return
+        await ctx.send("Playing effect :loud_sound:")
+
+    @bridge.bridge_command(
+        name="seek",
+        description=config.HELP_SEEK_LONG,
+        help=config.HELP_SEEK_SHORT,
+    )
+    @active_only
+    async def _seek(self, ctx: AudioContext, position: str):
+        try:
+            seconds = parse_time(position)
+        except ValueError:
+            await ctx.send(config.INVALID_SEEK_POSITION)
+            return
+        song = ctx.audiocontroller.current_song
+        duration = song.info.duration if song else None
+        if duration is not None and seconds >= duration:
+            await ctx.send(config.INVALID_SEEK_POSITION)
+            return
+        if not ctx.audiocontroller.seek(seconds):
+            await ctx.send(config.SEEK_UNAVAILABLE)
+            return
+        await ctx.send(
+            "Seeked to {} :fast_forward:".format(
+                datetime.timedelta(seconds=int(seconds))
+            )
+        )
+
     @bridge.bridge_command(
         name="clear",
         description=config.HELP_CLEAR_LONG,
@@ -0,0 +1,287 @@
+import ctypes
+import threading
+from collections import deque
+from typing import Deque, Iterable, List, Optional
+
+import discord
+from discord.opus import Encoder
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from config import config
+
+# largest gain change per frame, avoids clicks on volume changes
+MAX_GAIN_STEP = 0.2
+SAMPLE_LIMIT = 32767
+# frames of an overlay read ahead of the mixer
+OVERLAY_BUFFER = 10
+
+
+class Filter:
+    "Processes float32 frame of shape (samples, channels) in place"
+
+    def process(self, frame: "np.ndarray"):
+        raise NotImplementedError
+
+
+class SoftLimiter(Filter):
+    "Compresses peaks smoothly instead of clipping them"
+
+    def __init__(self, ceiling: float = 0.95):
+        self.scale = SAMPLE_LIMIT * ceiling
+
+    def process(self, frame):
+        frame /= self.scale
+        np.tanh(frame, out=frame)
+        frame *= self.scale
+
+
+FILTERS = {
+    "limiter": SoftLimiter,
+}
+
+
+def make_filters(names: Iterable[str]) -> List[Filter]:
+    return [FILTERS[name]() for name in names]
+
+
+class PCMProcessor(discord.AudioSource):
+    """Applies volume and filters to the PCM output of FFmpeg
+
+    Frames are read into a preallocated buffer and processed in place,
+    so nothing is allocated per frame. Volume changes are ramped
+    over several frames.
+
+    Attributes:
+        original: The FFmpeg source being processed.
+        volume: Target gain, 1.0 is unchanged.
+        filters: Filters applied after the gain.
+        tail: Bytes of audio in the last frame if the stream
+            ended in the middle of it, the rest is silence.
+    """
+
+    def __init__(
+        self,
+        original: discord.FFmpegPCMAudio,
+        volume: float = 1.0,
+        filters: Iterable[Filter] = (),
+    ):
+        self.original = original
+        self.volume = volume
+        self.filters = list(filters)
+        self.tail: Optional[int] = None
+        self._gain = volume
+        self._stream = original._stdout
+
+        self._buffer = bytearray(Encoder.FRAME_SIZE)
+        self._view = memoryview(self._buffer)
+        # the encoder accepts ctypes arrays as pointers
+        self._frame = (ctypes.c_char * Encoder.FRAME_SIZE).from_buffer(
+            self._buffer
+        )
+        self._samples = np.frombuffer(self._buffer, dtype=np.int16).reshape(
+            -1, Encoder.CHANNELS
+        )
+        self._work = np.empty(self._samples.shape, dtype=np.float32)
+        self._gains = np.empty((len(self._samples), 1), dtype=np.float32)
+        self._ramp = np.linspace(
+            0, 1, len(self._samples), endpoint=False, dtype=np.float32
+        ).reshape(-1, 1)
+
+    def read(self):
+        read = self._stream.readinto(self._view)
+        if not read:
+            return b""
+        if read != Encoder.FRAME_SIZE:
+            # keep the end of the song, pad it with silence
+            self._view[read:] = bytes(Encoder.FRAME_SIZE - read)
+            self.tail = read
+
+        start, target = self._gain, self.volume
+        if start == target == 1.0 and not self.filters:
+            return self._frame
+
+        np.copyto(self._work, self._samples)
+        if start != target:
+            step = max(min(target - start, MAX_GAIN_STEP), -MAX_GAIN_STEP)
+            end = start + step
+            np.multiply(self._ramp, end - start, out=self._gains)
+            self._gains += start
+            self._work *= self._gains
+            self._gain = end
+        elif start != 1.0:
+            self._work *= start
+
+        for f in self.filters:
+            f.process(self._work)
+
+        np.clip(self._work, -SAMPLE_LIMIT - 1, SAMPLE_LIMIT, out=self._work)
+        np.copyto(self._samples, self._work, casting="unsafe")
+        return self._frame
+
+    def fill(self, view: memoryview) -> int:
+        """Reads the beginning of the stream into the end of another frame
+        Returns number of bytes read"""
+        read = self._stream.readinto(view) or 0
+        if read and (self.volume != 1.0 or self.filters):
+            samples = np.frombuffer(view[:read], dtype=np.int16)
+            work = samples.astype(np.float32).reshape(-1, Encoder.CHANNELS)
+            work *= self.volume
+            for f in self.filters:
+                f.process(work)
+            np.clip(work, -SAMPLE_LIMIT - 1, SAMPLE_LIMIT, out=work)
+            np.copyto(samples, work.reshape(-1), casting="unsafe")
+        self._gain = self.volume
+        return read
+
+    def splice(self, following: "PCMProcessor"):
+        "Completes the padded last frame with the start of the following one"
+        following.fill(self._view[self.tail :])
+
+    def mix(self, incoming: "PCMProcessor", start: float, end: float):
+        """Crossfades the last frame of `incoming` into the last frame
+        `start` and `end` are shares of `incoming` at the frame edges"""
+        fade = self._gains
+        np.multiply(self._ramp, end - start, out=fade)
+        fade += start
+        np.multiply(incoming._samples, fade, out=incoming._work)
+        np.subtract(1, fade, out=fade)
+        np.multiply(self._samples, fade, out=self._work)
+        self._work += incoming._work
+        np.copyto(self._samples, self._work, casting="unsafe")
+
+    def cleanup(self):
+        self.original.cleanup()
+
+
+class BufferedOverlay:
+    """PCM source read ahead by its own thread,
+    so the player never waits for FFmpeg to start
+
+    Attributes:
+        ended: Set when the source has ended and all its frames were taken.
+    """
+
+    def __init__(self, original: discord.AudioSource):
+        self.original = original
+        self._frames: Deque[bytes] = deque()
+        self._condition = threading.Condition()
+        self._done = False
+        self._stopped = False
+        threading.Thread(
+            target=self._run, name="overlay reader", daemon=True
+        ).start()
+
+    @property
+    def ended(self) -> bool:
+        return self._done and not self._frames
+
+    def _run(self):
+        try:
+            while True:
+                with self._condition:
+                    while (
+                        len(self._frames) >= OVERLAY_BUFFER
+                        and not self._stopped
+                    ):
+                        self._condition.wait()
+                    if self._stopped:
+                        break
+                data = self.original.read()
+                if len(data) != Encoder.FRAME_SIZE:
+                    break
+                self._frames.append(data)
+        except Exception:
+            # reading fails if the source was cleaned up meanwhile
+            pass
+        finally:
+            self._done = True
+
+    def frame(self) -> Optional[bytes]:
+        "Returns the next frame, None if it wasn't read yet"
+        if not self._frames:
+            return None
+        data = self._frames.popleft()
+        with self._condition:
+            self._condition.notify()
+        return data
+
+    def cleanup(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self.original.cleanup()
+
+
+class OverlayMixer:
+    """Adds short PCM sources on top of music frames
+
+    The sum is computed in preallocated buffers and clipped,
+    overlays are dropped when they end. Overlays are read ahead,
+    frames that aren't ready are skipped instead of waited for.
+
+    Attributes:
+        overlays: Sources being mixed in.
+    """
+
+    def __init__(self):
+        self.overlays: List[BufferedOverlay] = []
+        self._buffer = bytearray(Encoder.FRAME_SIZE)
+        self._frame = (ctypes.c_char * Encoder.FRAME_SIZE).from_buffer(
+            self._buffer
+        )
+        self._samples = np.frombuffer(self._buffer, dtype=np.int16).reshape(
+            -1, Encoder.CHANNELS
+        )
+        self._work = np.empty(self._samples.shape, dtype=np.float32)
+        self._scaled = np.empty(self._samples.shape, dtype=np.float32)
+
+    def __len__(self):
+        return len(self.overlays)
+
+    def add(self, overlay: discord.AudioSource):
+        self.overlays.append(BufferedOverlay(overlay))
+
+    def mix(self, frame, volume: float):
+        """Returns the frame with overlays added at the volume
+        The result is valid until the next call"""
+        np.copyto(
+            self._work,
+            np.frombuffer(frame, dtype=np.int16).reshape(-1, Encoder.CHANNELS),
+        )
+        active = []
+        for overlay in self.overlays:
+            if overlay.ended:
+                overlay.cleanup()
+                continue
+            active.append(overlay)
+            data = overlay.frame()
+            if data is None:
+                continue
+            samples = np.frombuffer(data, dtype=np.int16).reshape(
+                -1, Encoder.CHANNELS
+            )
+            np.multiply(samples, volume, out=self._scaled)
+            self._work += self._scaled
+        self.overlays = active
+
+        np.clip(self._work, -SAMPLE_LIMIT - 1, SAMPLE_LIMIT, out=self._work)
+        np.copyto(self._samples, self._work, casting="unsafe")
+        return self._frame
+
+    def cleanup(self):
+        for overlay in self.overlays:
+            overlay.cleanup()
+        self.overlays = []
+
+
+def process_pcm(
+    original: discord.AudioSource, volume: float
+) -> discord.AudioSource:
+    "Wraps PCM source with the best available volume control"
+    if np is None:
+        return discord.PCMVolumeTransformer(original, volume)
+    return PCMProcessor(original, volume, make_filters(config.AUDIO_FILTERS))
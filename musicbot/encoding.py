@@ -0,0 +1,362 @@
+import sys
+import time
+import struct
+import threading
+from multiprocessing import get_context as mp_context
+from multiprocessing.shared_memory import SharedMemory
+from typing import List, NamedTuple, Optional
+
+import discord
+from discord import opus
+from discord.opus import Encoder
+
+from config import config
+from musicbot import dsp
+
+# not wrapped by discord.opus
+CTL_SET_COMPLEXITY = 4010
+# kbps, forward error correction makes Opus use its speech modes
+# and doubles encoding time, it's kept for channels where
+# the audio is degraded anyway
+FEC_MAX_BITRATE = 48
+# complexity by the lowest channel bitrate in kbps it's used for,
+# higher complexity is only heard when there are bits to spare
+COMPLEXITY_BY_BITRATE = ((128, 9), (96, 8), (0, 6))
+
+# packets encoded ahead of playback, volume changes are heard this late
+RING_PACKETS = 10
+# encoder output is limited to the size of the PCM frame
+MAX_PACKET = Encoder.FRAME_SIZE
+# seconds between checks of the ring when it's full or empty
+POLL_INTERVAL = 0.002
+
+# the writer and the reader never write the same field
+WRITE_SEQUENCE = struct.Struct("<Q")  # offset 0, next packet to write
+READ_SEQUENCE = struct.Struct("<Q")  # offset 8, next packet to read
+VOLUME = struct.Struct("<d")  # offset 16
+FLAG = struct.Struct("<B")  # offset 24 ended, offset 25 closed
+# offset 26 bitrate, 0 for default settings,
+# offset 28 complexity, offset 29 FEC
+SETTINGS = struct.Struct("<HBB")
+PID = struct.Struct("<I")  # offset 32, FFmpeg process id, 0 until started
+HEADER_SIZE = 40
+LENGTH = struct.Struct("<H")
+SLOT_SIZE = LENGTH.size + MAX_PACKET
+RING_SIZE = HEADER_SIZE + RING_PACKETS * SLOT_SIZE
+
+
+class EncoderSettings(NamedTuple):
+    "Opus encoder settings, bitrate is in kbps"
+
+    bitrate: int
+    complexity: int
+    fec: bool
+
+
+# close to what discord.opus.Encoder starts with
+DEFAULT_SETTINGS = EncoderSettings(128, 10, True)
+
+
+def is_default(settings: Optional[EncoderSettings]) -> bool:
+    """Checks if packets encoded with the settings may be cached,
+    others are degraded for the channels they weren't chosen for"""
+    return settings is None or settings == DEFAULT_SETTINGS
+
+
+def settings_for(bitrate: Optional[int]) -> Optional[EncoderSettings]:
+    """Returns encoder settings for voice channel bitrate in kbps,
+    None to keep the defaults of discord.opus.Encoder"""
+    if bitrate is None or not config.MATCH_CHANNEL_BITRATE:
+        return None
+    complexity = next(c for b, c in COMPLEXITY_BY_BITRATE if bitrate >= b)
+    return EncoderSettings(bitrate, complexity, bitrate <= FEC_MAX_BITRATE)
+
+
+def configure(encoder: Encoder, settings: EncoderSettings):
+    encoder.set_bitrate(settings.bitrate)
+    opus._lib.opus_encoder_ctl(
+        encoder._state, CTL_SET_COMPLEXITY, settings.complexity
+    )
+    encoder.set_fec(settings.fec)
+
+
+_context = mp_context("spawn")
+_workers: List["_Worker"] = []
+_workers_lock = threading.Lock()
+
+
+class _Ring:
+    """Opus packets of one stream in shared memory
+    Written by the worker process, read by the player"""
+
+    def __init__(self, buffer: memoryview):
+        self.buffer = buffer
+
+    def _slot(self, sequence: int) -> int:
+        return HEADER_SIZE + sequence % RING_PACKETS * SLOT_SIZE
+
+    @property
+    def write_sequence(self) -> int:
+        return WRITE_SEQUENCE.unpack_from(self.buffer, 0)[0]
+
+    @property
+    def read_sequence(self) -> int:
+        return READ_SEQUENCE.unpack_from(self.buffer, 8)[0]
+
+    @property
+    def volume(self) -> float:
+        return VOLUME.unpack_from(self.buffer, 16)[0]
+
+    @volume.setter
+    def volume(self, value: float):
+        VOLUME.pack_into(self.buffer, 16, value)
+
+    @property
+    def ended(self) -> bool:
+        return bool(FLAG.unpack_from(self.buffer, 24)[0])
+
+    def end(self):
+        FLAG.pack_into(self.buffer, 24, 1)
+
+    @property
+    def closed(self) -> bool:
+        return bool(FLAG.unpack_from(self.buffer, 25)[0])
+
+    def close(self):
+        FLAG.pack_into(self.buffer, 25, 1)
+
+    @property
+    def pid(self) -> int:
+        return PID.unpack_from(self.buffer, 32)[0]
+
+    @pid.setter
+    def pid(self, value: int):
+        PID.pack_into(self.buffer, 32, value)
+
+    @property
+    def settings(self) -> Optional[EncoderSettings]:
+        bitrate, complexity, fec = SETTINGS.unpack_from(self.buffer, 26)
+        if not bitrate:
+            return None
+        return EncoderSettings(bitrate, complexity, bool(fec))
+
+    @settings.setter
+    def settings(self, value: Optional[EncoderSettings]):
+        SETTINGS.pack_into(self.buffer, 26, *(value or (0, 0, False)))
+
+    def put(self, packet: bytes) -> bool:
+        "Appends the packet, returns False if the ring is full"
+        written = self.write_sequence
+        if written - self.read_sequence >= RING_PACKETS:
+            return False
+        offset = self._slot(written)
+        LENGTH.pack_into(self.buffer, offset, len(packet))
+        start = offset + LENGTH.size
+        self.buffer[start : start + len(packet)] = packet
+        # the packet must be complete before it's published
+        WRITE_SEQUENCE.pack_into(self.buffer, 0, written + 1)
+        return True
+
+    def get(self) -> Optional[bytes]:
+        "Returns the next packet, None if none is ready"
+        read = self.read_sequence
+        if read == self.write_sequence:
+            return None
+        offset = self._slot(read)
+        (length,) = LENGTH.unpack_from(self.buffer, offset)
+        start = offset + LENGTH.size
+        packet = bytes(self.buffer[start : start + length])
+        READ_SEQUENCE.pack_into(self.buffer, 8, read + 1)
+        return packet
+
+
+def _encode_stream(
+    name: str, source: str, before_options: str, options: str
+):
+    "Runs in a thread of the worker, encodes one stream into its ring"
+    try:
+        memory = SharedMemory(name)
+    except FileNotFoundError:
+        # closed before it started
+        return
+    ring = _Ring(memory.buf)
+    track = None
+    try:
+        ffmpeg = discord.FFmpegPCMAudio(
+            source,
+            before_options=before_options,
+            options=options,
+            stderr=sys.stderr,
+        )
+        # accounted by the bot process like its own FFmpeg processes
+        ring.pid = ffmpeg._process.pid
+        track = dsp.process_pcm(ffmpeg, ring.volume)
+        encoder = Encoder()
+        settings = None
+        while not ring.closed:
+            track.volume = ring.volume
+            if ring.settings != settings:
+                settings = ring.settings
+                # None goes back to the defaults of a new encoder
+                configure(encoder, settings or DEFAULT_SETTINGS)
+            data = track.read()
+            if not data:
+                break
+            packet = encoder.encode(data, Encoder.SAMPLES_PER_FRAME)
+            while not ring.put(packet):
+                if ring.closed:
+                    break
+                time.sleep(POLL_INTERVAL)
+    except Exception as e:
+        print("Encoding worker failed:", e, file=sys.stderr)
+    finally:
+        ring.end()
+        if track is not None:
+            track.cleanup()
+        memory.close()
+
+
+def _serve(connection):
+    "Main function of a worker process"
+    try:
+        while True:
+            try:
+                args = connection.recv()
+            except EOFError:
+                return
+            threading.Thread(
+                target=_encode_stream, args=args, daemon=True
+            ).start()
+    except KeyboardInterrupt:
+        pass
+
+
+class _Worker:
+    def __init__(self):
+        self.connection, child = _context.Pipe()
+        self.process = _context.Process(
+            target=_serve, args=(child,), daemon=True
+        )
+        self.process.start()
+        child.close()
+        self.streams = 0
+
+
+def _start(*args) -> "_Worker":
+    "Starts encoding in the least busy worker"
+    with _workers_lock:
+        if len(_workers) < config.ENCODER_PROCESSES:
+            _workers.append(_Worker())
+        worker = min(_workers, key=lambda w: w.streams)
+        try:
+            worker.connection.send(args)
+        except OSError:
+            # the worker died, replace it
+            _workers.remove(worker)
+            worker = _Worker()
+            _workers.append(worker)
+            worker.connection.send(args)
+        worker.streams += 1
+        return worker
+
+
+class RemoteTrack(discord.AudioSource):
+    """Song decoded and encoded in a worker process
+    Plays the opus packets it produces, volume is applied by the worker
+
+    Attributes:
+        volume: Gain applied by the worker, changes are heard
+            RING_PACKETS frames later.
+        settings: Settings of the encoder in the worker,
+            applied as late as volume.
+        pid: Id of the FFmpeg process started by the worker,
+            None until it's started or after cleanup.
+    """
+
+    def __init__(self, source: str, before_options: str, options: str):
+        # cleanup() is called by __del__ even if starting fails
+        self._worker: Optional[_Worker] = None
+        # cleanup may run in another thread while the player reads
+        self._lock = threading.Lock()
+        self._memory = SharedMemory(create=True, size=RING_SIZE)
+        self._ring = _Ring(self._memory.buf)
+        self._ring.volume = 1.0
+        try:
+            self._worker = _start(
+                self._memory.name, source, before_options, options
+            )
+        except BaseException:
+            self._memory.close()
+            self._memory.unlink()
+            raise
+
+    @property
+    def volume(self) -> float:
+        return self._ring.volume
+
+    @volume.setter
+    def volume(self, value: float):
+        with self._lock:
+            # the ring is released by cleanup
+            if self._worker is None:
+                return
+            self._ring.volume = value
+
+    @property
+    def settings(self) -> Optional[EncoderSettings]:
+        return self._ring.settings
+
+    @settings.setter
+    def settings(self, value: Optional[EncoderSettings]):
+        with self._lock:
+            if self._worker is None:
+                return
+            self._ring.settings = value
+
+    @property
+    def pid(self) -> Optional[int]:
+        with self._lock:
+            if self._worker is None:
+                return None
+            return self._ring.pid or None
+
+    def is_opus(self) -> bool:
+        return True
+
+    def read(self) -> bytes:
+        while True:
+            with self._lock:
+                if self._worker is None:
+                    return b""
+                packet = self._ring.get()
+                if packet is not None:
+                    return packet
+                if self._ring.ended:
+                    # the last packets could be written before the flag
+                    return self._ring.get() or b""
+                if not self._worker.process.is_alive():
+                    # killed or crashed before it could end the stream
+                    print("Encoding worker died", file=sys.stderr)
+                    return b""
+            time.sleep(POLL_INTERVAL)
+
+    def cleanup(self):
+        with self._lock:
+            if self._worker is None:
+                return
+            with _workers_lock:
+                self._worker.streams -= 1
+            self._worker = None
+            self._ring.close()
+            self._memory.close()
+            # the worker keeps its mapping until it notices
+            self._memory.unlink()
+
+
+def stats() -> Optional[str]:
+    with _workers_lock:
+        if not _workers:
+            return None
+        return "{} streams in {} encoding processes".format(
+            sum(w.streams for w in _workers), len(_workers)
+        )
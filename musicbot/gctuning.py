@@ -0,0 +1,90 @@
+import gc
+import time
+from collections import Counter, deque
+from typing import TYPE_CHECKING, Deque, Tuple
+
+from config import config
+
+# avoiding circular import
+if TYPE_CHECKING:
+    from musicbot.bot import MusicBot
+
+# collection pauses to remember
+PAUSE_HISTORY = 1000
+# full collection threshold that is never reached, it's a C int
+NEVER = 2**31 - 1
+
+# generation and seconds of the latest collections
+pauses: Deque[Tuple[int, float]] = deque(maxlen=PAUSE_HISTORY)
+collections = Counter()
+_started_at = time.monotonic()
+_collection_start = 0.0
+_last_full = time.monotonic()
+
+
+def _record(phase: str, info: dict):
+    global _collection_start, _last_full
+    if phase == "start":
+        _collection_start = time.perf_counter()
+        return
+    generation = info["generation"]
+    pauses.append((generation, time.perf_counter() - _collection_start))
+    collections[generation] += 1
+    if generation == 2:
+        _last_full = time.monotonic()
+
+
+def install():
+    "Starts recording collection pauses, tunes the collector if enabled"
+    if _record not in gc.callbacks:
+        gc.callbacks.append(_record)
+    if config.TUNE_GC:
+        young, middle = config.GC_THRESHOLDS[:2]
+        # full collections are left to collect_if_idle
+        gc.set_threshold(young, middle, NEVER)
+
+
+def freeze():
+    """Moves everything allocated so far out of the collector's sight
+    Called once the long-lived objects are loaded"""
+    if not config.TUNE_GC:
+        return
+    gc.collect()
+    gc.freeze()
+
+
+def collect_if_idle(bot: "MusicBot"):
+    """Runs the deferred full collection if no guild is playing,
+    or if it was deferred for too long"""
+    if not config.TUNE_GC or gc.get_count()[2] == 0:
+        return
+    playing = any(vc.is_playing() for vc in bot.voice_clients)
+    if playing and time.monotonic() - _last_full < config.GC_MAX_DEFER:
+        return
+    gc.collect()
+
+
+def stats() -> str:
+    minutes = (time.monotonic() - _started_at) / 60
+    durations = sorted(duration for _, duration in pauses)
+    if not durations:
+        return "no collections yet"
+    longest_full = max(
+        (duration for generation, duration in pauses if generation == 2),
+        default=0.0,
+    )
+    return (
+        "{} thresholds {}, {:.1f} collections per minute"
+        " (generations {}/{}/{}), p99 pause {:.1f} ms, max {:.1f} ms,"
+        " max full {:.1f} ms".format(
+            "tuned" if config.TUNE_GC else "default",
+            gc.get_threshold(),
+            sum(collections.values()) / minutes,
+            collections[0],
+            collections[1],
+            collections[2],
+            durations[int(len(durations) * 0.99)] * 1000,
+            durations[-1] * 1000,
+            longest_full * 1000,
+        )
+    )
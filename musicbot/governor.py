@@ -0,0 +1,171 @@
+import time
+import traceback
+from collections import deque
+from datetime import datetime
+from typing import TYPE_CHECKING, Deque, NamedTuple, Optional, Tuple
+
+from sqlalchemy.orm import Mapped, mapped_column
+
+from config import config
+from musicbot import encoding, scheduler
+from musicbot.settings import Base
+
+# avoiding circular import
+if TYPE_CHECKING:
+    from musicbot.bot import MusicBot
+
+# seconds between checks, run by the bot
+CHECK_INTERVAL = 5
+# calm checks in a row needed to raise the quality by one level
+RECOVERY_CHECKS = 6
+# the load must drop this far below the limits to be calm
+CALM_FACTOR = 0.5
+# fewer frames sent between checks don't tell anything
+MIN_FRAMES = 50
+# transitions to keep in memory for the stats
+TRANSITION_HISTORY = 20
+
+
+class Level(NamedTuple):
+    """Limits of one quality level
+
+    Attributes:
+        complexity: Highest Opus complexity, None for no limit.
+        bitrate: Highest bitrate in kbps, None for no limit.
+        fec: Allows forward error correction.
+        passthrough: Sends opus songs without decoding them,
+            even if volume or loudness correction is lost.
+    """
+
+    complexity: Optional[int]
+    bitrate: Optional[int]
+    fec: bool
+    passthrough: bool
+
+
+# lowered in this order, cheapest loss of quality first
+LEVELS = (
+    Level(None, None, True, False),
+    # FEC doubles encoding time
+    Level(6, None, False, False),
+    Level(4, 96, False, False),
+    Level(2, 64, False, False),
+    Level(2, 64, False, True),
+)
+
+
+class QualityTransition(Base):
+    __tablename__ = "quality_transitions"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    changed_at: Mapped[datetime] = mapped_column(index=True)
+    from_level: Mapped[int]
+    to_level: Mapped[int]
+    late_frames: Mapped[float]
+    cpu: Mapped[float]
+
+
+level = 0
+transitions: Deque[QualityTransition] = deque(maxlen=TRANSITION_HISTORY)
+_calm_checks = 0
+_last_check: Optional[Tuple[float, float, int, int]] = None
+
+
+def limit(
+    settings: Optional[encoding.EncoderSettings],
+) -> Optional[encoding.EncoderSettings]:
+    "Applies limits of the current level to encoder settings"
+    if level == 0:
+        return settings
+    current = LEVELS[level]
+    settings = settings or encoding.DEFAULT_SETTINGS
+    return encoding.EncoderSettings(
+        min(settings.bitrate, current.bitrate or settings.bitrate),
+        min(settings.complexity, current.complexity or settings.complexity),
+        settings.fec and current.fec,
+    )
+
+
+def forces_passthrough() -> bool:
+    return LEVELS[level].passthrough
+
+
+def _measure() -> Optional[Tuple[float, float]]:
+    """Returns share of late frames and share of a core used
+    by the bot process since the last check, None on the first check"""
+    global _last_check
+    now = time.perf_counter()
+    cpu_time = time.process_time()
+    frames, misses = scheduler.counters()
+    last, _last_check = _last_check, (now, cpu_time, frames, misses)
+    if last is None:
+        return None
+    sent = frames - last[2]
+    late = (misses - last[3]) / sent if sent >= MIN_FRAMES else 0.0
+    return late, (cpu_time - last[1]) / (now - last[0])
+
+
+async def check(bot: "MusicBot"):
+    """Lowers the quality by one level if the bot can't keep up,
+    raises it by one level after it was calm for a while"""
+    global _calm_checks
+    measured = _measure()
+    if measured is None:
+        return
+    late, cpu = measured
+    if late > config.GOVERNOR_MAX_LATE or cpu > config.GOVERNOR_MAX_CPU:
+        _calm_checks = 0
+        if level < len(LEVELS) - 1:
+            await _change_level(bot, level + 1, late, cpu)
+    elif (
+        late <= config.GOVERNOR_MAX_LATE * CALM_FACTOR
+        and cpu <= config.GOVERNOR_MAX_CPU * CALM_FACTOR
+    ):
+        _calm_checks += 1
+        if level > 0 and _calm_checks >= RECOVERY_CHECKS:
+            _calm_checks = 0
+            await _change_level(bot, level - 1, late, cpu)
+    else:
+        _calm_checks = 0
+
+
+async def _change_level(
+    bot: "MusicBot", to_level: int, late: float, cpu: float
+):
+    global level
+    transition = QualityTransition(
+        changed_at=datetime.utcnow(),
+        from_level=level,
+        to_level=to_level,
+        late_frames=late,
+        cpu=cpu,
+    )
+    print(
+        "Quality level {} -> {}: {:.1%} frames late, {:.0%} CPU".format(
+            level, to_level, late, cpu
+        )
+    )
+    async with bot.DbSession() as session:
+        session.add(transition)
+        await session.commit()
+    level = to_level
+    transitions.append(transition)
+    for audiocontroller in bot.audio_controllers.values():
+        try:
+            audiocontroller.apply_quality()
+        except Exception:
+            # one guild shouldn't stop the others from following
+            traceback.print_exc()
+
+
+def stats() -> str:
+    return "level {} of {}{}".format(
+        level,
+        len(LEVELS) - 1,
+        "".join(
+            ", {:%H:%M:%S} {} -> {}".format(
+                t.changed_at, t.from_level, t.to_level
+            )
+            for t in list(transitions)[-3:]
+        ),
+    )
@@ -0,0 +1,74 @@
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING, Dict, List
+
+import discord
+from sqlalchemy import String, delete, func, select
+from sqlalchemy.orm import Mapped, mapped_column
+
+from config import config
+from musicbot.settings import Base, DiscordIdStr
+from musicbot.songinfo import Song
+
+# avoiding circular import
+if TYPE_CHECKING:
+    from musicbot.bot import MusicBot
+
+REQUEST_LENGTH = 1024
+
+
+class PlayRecord(Base):
+    __tablename__ = "play_history"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    guild_id: Mapped[DiscordIdStr] = mapped_column(index=True)
+    request: Mapped[str] = mapped_column(String(REQUEST_LENGTH))
+    played_at: Mapped[datetime] = mapped_column(index=True)
+
+
+def history_start() -> datetime:
+    "Returns the oldest time that is still considered recent"
+    return datetime.utcnow() - timedelta(days=config.WARMUP_HISTORY_DAYS)
+
+
+async def record_play(bot: "MusicBot", guild: discord.Guild, song: Song):
+    "Remembers that the song was played in the guild"
+    if not song.request or len(song.request) > REQUEST_LENGTH:
+        return
+    async with bot.DbSession() as session:
+        session.add(
+            PlayRecord(
+                guild_id=str(guild.id),
+                request=song.request,
+                played_at=datetime.utcnow(),
+            )
+        )
+        await session.commit()
+
+
+async def prune(bot: "MusicBot"):
+    "Deletes records that are too old to be used"
+    async with bot.DbSession() as session:
+        await session.execute(
+            delete(PlayRecord).where(PlayRecord.played_at < history_start())
+        )
+        await session.commit()
+
+
+async def most_played(bot: "MusicBot", limit: int) -> Dict[str, List[str]]:
+    """Finds the most played tracks of recent history
+    Returns dict with guild ids as keys
+    and up to `limit` requests sorted by play count as values"""
+    plays = func.count().label("plays")
+    async with bot.DbSession() as session:
+        rows = await session.execute(
+            select(PlayRecord.guild_id, PlayRecord.request, plays)
+            .where(PlayRecord.played_at >= history_start())
+            .group_by(PlayRecord.guild_id, PlayRecord.request)
+            .order_by(plays.desc())
+        )
+    result = {}
+    for guild_id, request, _ in rows:
+        requests = result.setdefault(guild_id, [])
+        if len(requests) < limit:
+            requests.append(request)
+    return result
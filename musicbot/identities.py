@@ -0,0 +1,115 @@
+import time
+from typing import Callable, Iterable, List, Optional
+
+from config import config
+
+# parts of extractor errors that mean we are being rate limited
+THROTTLE_MARKERS = (
+    "HTTP Error 429",
+    "Too Many Requests",
+    "confirm you're not a bot",
+    "confirm you’re not a bot",
+    "rate-limited",
+)
+# cooldown doesn't grow beyond this many seconds
+MAX_COOLDOWN = 3600
+
+
+def is_throttle_message(message: str) -> bool:
+    return any(marker in message for marker in THROTTLE_MARKERS)
+
+
+class Identity:
+    """Set of extractor options that the site sees as a separate user
+
+    Attributes:
+        name: Human-readable description used in stats.
+        options: Options merged into every extractor call.
+        strikes: How many times it was throttled recently.
+        cooldown_until: Clock value until which it should not be used.
+    """
+
+    def __init__(
+        self,
+        cookiefile: Optional[str] = None,
+        player_client: Optional[str] = None,
+    ):
+        self.options = {}
+        if cookiefile:
+            self.options["cookiefile"] = cookiefile
+        if player_client:
+            self.options["extractor_args"] = {
+                "youtube": {"player_client": [player_client]}
+            }
+        self.name = " ".join(filter(None, (cookiefile, player_client)))
+        self.name = self.name or "default"
+
+        self.strikes = 0
+        self.cooldown_until = 0.0
+        self.active_jobs = 0
+        self.jobs = 0
+        self.throttles = 0
+
+
+class IdentityPool:
+    "Spreads jobs between identities and rests the throttled ones"
+
+    def __init__(
+        self,
+        identities: Iterable[Identity],
+        cooldown: float,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.identities: List[Identity] = list(identities)
+        if not self.identities:
+            raise ValueError("identity pool can't be empty")
+        self.cooldown = cooldown
+        self.clock = clock
+
+    @classmethod
+    def from_config(cls) -> "IdentityPool":
+        identities = [
+            Identity(i.get("cookiefile"), i.get("player_client"))
+            for i in config.EXTRACTION_IDENTITIES
+        ] or [Identity(config.COOKIE_PATH)]
+        return cls(identities, config.IDENTITY_COOLDOWN)
+
+    def __len__(self):
+        return len(self.identities)
+
+    def acquire(self) -> Optional[Identity]:
+        """Picks the least throttled identity that is not cooling down
+        Returns None if all of them are"""
+        now = self.clock()
+        rested = [i for i in self.identities if i.cooldown_until <= now]
+        if not rested:
+            return None
+        identity = min(
+            rested, key=lambda i: (i.strikes, i.active_jobs, i.jobs)
+        )
+        identity.active_jobs += 1
+        return identity
+
+    def release(self, identity: Identity, throttled: bool):
+        identity.active_jobs -= 1
+        identity.jobs += 1
+        if throttled:
+            identity.throttles += 1
+            identity.strikes += 1
+            identity.cooldown_until = self.clock() + min(
+                self.cooldown * 2 ** (identity.strikes - 1), MAX_COOLDOWN
+            )
+        else:
+            identity.strikes = max(identity.strikes - 1, 0)
+
+    def stats(self) -> List[str]:
+        now = self.clock()
+        return [
+            f"{i.name}: {i.jobs} jobs, {i.throttles} throttled"
+            + (
+                f", resting {int(i.cooldown_until - now)}s"
+                if i.cooldown_until > now
+                else ""
+            )
+            for i in self.identities
+        ]
@@ -0,0 +1,267 @@
+import os
+import re
+import sys
+import json
+import asyncio
+from bisect import bisect_left
+from typing import TYPE_CHECKING, Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import String, delete, select
+from sqlalchemy.orm import Mapped, mapped_column
+
+from config import config
+from musicbot.history import REQUEST_LENGTH
+from musicbot.linkutils import Origins, Sites
+from musicbot.settings import Base
+from musicbot.songinfo import Song
+
+# avoiding circular import
+if TYPE_CHECKING:
+    from musicbot.bot import MusicBot
+
+TAG_LENGTH = 256
+# files probed at once during a scan
+PROBE_CONCURRENCY = 4
+# probed files saved in one transaction
+COMMIT_BATCH = 100
+WORD_REGEX = re.compile(r"\w+")
+
+
+class LibraryTrack(Base):
+    __tablename__ = "library_tracks"
+
+    path: Mapped[str] = mapped_column(
+        String(REQUEST_LENGTH), primary_key=True
+    )
+    mtime: Mapped[float]
+    title: Mapped[str] = mapped_column(String(TAG_LENGTH))
+    artist: Mapped[Optional[str]] = mapped_column(String(TAG_LENGTH))
+    album: Mapped[Optional[str]] = mapped_column(String(TAG_LENGTH))
+    duration: Mapped[Optional[int]]
+
+
+# indexed tracks by path
+_tracks: Dict[str, LibraryTrack] = {}
+# paths of tracks by every word of their tags
+_tokens: Dict[str, Set[str]] = {}
+# keys of _tokens, sorted for prefix lookups
+_sorted_tokens: List[str] = []
+# modification times of files FFprobe couldn't read, by path
+_unreadable: Dict[str, float] = {}
+_scan_lock = asyncio.Lock()
+
+
+def _words(text: Optional[str]) -> List[str]:
+    return WORD_REGEX.findall(text.lower()) if text else []
+
+
+def _track_words(track: LibraryTrack) -> Set[str]:
+    stem = os.path.splitext(os.path.basename(track.path))[0]
+    return {
+        word
+        for text in (track.title, track.artist, track.album, stem)
+        for word in _words(text)
+    }
+
+
+def _add(track: LibraryTrack):
+    _tracks[track.path] = track
+    for word in _track_words(track):
+        _tokens.setdefault(word, set()).add(track.path)
+
+
+def _remove(path: str):
+    track = _tracks.pop(path, None)
+    if track is None:
+        return
+    for word in _track_words(track):
+        paths = _tokens[word]
+        paths.discard(path)
+        if not paths:
+            del _tokens[word]
+
+
+def _sort_tokens():
+    global _sorted_tokens
+    _sorted_tokens = sorted(_tokens)
+
+
+def _matching(word: str) -> Tuple[Set[str], Set[str]]:
+    "Returns paths with the exact word and paths with a word it prefixes"
+    exact = _tokens.get(word, set())
+    prefixed = set()
+    i = bisect_left(_sorted_tokens, word)
+    while i < len(_sorted_tokens) and _sorted_tokens[i].startswith(word):
+        prefixed |= _tokens[_sorted_tokens[i]]
+        i += 1
+    return exact, prefixed
+
+
+def search(query: str) -> Optional[LibraryTrack]:
+    """Returns the track best matching the query, None if no track
+    has every word of the query as a word or a beginning of one"""
+    words = _words(query)
+    if not words or not _tracks:
+        return None
+    found: Optional[Set[str]] = None
+    exact_counts: Dict[str, int] = {}
+    for word in words:
+        exact, prefixed = _matching(word)
+        found = prefixed if found is None else found & prefixed
+        if not found:
+            return None
+        for path in exact:
+            exact_counts[path] = exact_counts.get(path, 0) + 1
+    # whole words first, then the shortest title, it has least extra words
+    best = min(
+        found,
+        key=lambda path: (
+            -exact_counts.get(path, 0),
+            len(_tracks[path].title),
+            path,
+        ),
+    )
+    return _tracks[best]
+
+
+def to_song(track: LibraryTrack) -> Song:
+    "Creates a song playing the file directly"
+    return Song(
+        Origins.Default,
+        Sites.Local,
+        base_url=track.path,
+        uploader=track.artist or config.SONGINFO_UNKNOWN,
+        title=track.title,
+        duration=track.duration,
+        webpage_url=track.path,
+    )
+
+
+def find(query: str) -> Optional[Song]:
+    "Returns a song of the library matching the query"
+    if not config.LIBRARY_DIR:
+        return None
+    track = search(query)
+    return to_song(track) if track else None
+
+
+async def load(bot: "MusicBot"):
+    "Indexes tracks found by previous scans"
+    async with bot.DbSession() as session:
+        tracks = (await session.execute(select(LibraryTrack))).scalars()
+        for track in tracks:
+            _add(track)
+    _sort_tokens()
+
+
+def _list_files(directory: str) -> Dict[str, float]:
+    "Returns modification times of supported files by absolute path"
+    files = {}
+    for root, _, names in os.walk(directory, followlinks=True):
+        for name in names:
+            if not name.lower().endswith(config.SUPPORTED_EXTENSIONS):
+                continue
+            path = os.path.abspath(os.path.join(root, name))
+            if len(path) > REQUEST_LENGTH:
+                continue
+            try:
+                files[path] = os.stat(path).st_mtime
+            except OSError:
+                # removed while listing
+                pass
+    return files
+
+
+async def probe(path: str, mtime: float) -> Optional[LibraryTrack]:
+    "Reads tags and duration of the file with FFprobe"
+    process = await asyncio.create_subprocess_exec(
+        "ffprobe",
+        "-v",
+        "error",
+        "-show_entries",
+        "format=duration:format_tags=title,artist,album",
+        "-of",
+        "json",
+        path,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL,
+    )
+    output, _ = await process.communicate()
+    if process.returncode != 0:
+        return None
+    try:
+        info = json.loads(output)["format"]
+    except (ValueError, KeyError):
+        return None
+    # tag names differ in case between containers
+    tags = {k.lower(): v for k, v in info.get("tags", {}).items()}
+    try:
+        duration = round(float(info["duration"]))
+    except (KeyError, ValueError):
+        duration = None
+    title = tags.get("title") or os.path.splitext(os.path.basename(path))[0]
+    return LibraryTrack(
+        path=path,
+        mtime=mtime,
+        title=title[:TAG_LENGTH],
+        artist=tags.get("artist", "")[:TAG_LENGTH] or None,
+        album=tags.get("album", "")[:TAG_LENGTH] or None,
+        duration=duration,
+    )
+
+
+async def scan(bot: "MusicBot"):
+    """Indexes files of the library directory
+    Only new and modified files are probed, removed files are dropped"""
+    async with _scan_lock:
+        files = await asyncio.get_running_loop().run_in_executor(
+            None, _list_files, config.LIBRARY_DIR
+        )
+        removed = [path for path in _tracks if path not in files]
+        changed = [
+            (path, mtime)
+            for path, mtime in files.items()
+            if (path not in _tracks or _tracks[path].mtime != mtime)
+            and _unreadable.get(path) != mtime
+        ]
+        if removed:
+            async with bot.DbSession() as session:
+                await session.execute(
+                    delete(LibraryTrack).where(LibraryTrack.path.in_(removed))
+                )
+                await session.commit()
+            for path in removed:
+                _remove(path)
+            _sort_tokens()
+
+        semaphore = asyncio.Semaphore(PROBE_CONCURRENCY)
+
+        async def limited_probe(path: str, mtime: float):
+            async with semaphore:
+                return await probe(path, mtime)
+
+        failed = 0
+        for i in range(0, len(changed), COMMIT_BATCH):
+            batch = changed[i : i + COMMIT_BATCH]
+            probed = await asyncio.gather(
+                *(limited_probe(path, mtime) for path, mtime in batch)
+            )
+            tracks = []
+            for (path, mtime), track in zip(batch, probed):
+                if track is None:
+                    _unreadable[path] = mtime
+                    failed += 1
+                else:
+                    tracks.append(track)
+            async with bot.DbSession() as session:
+                for track in tracks:
+                    await session.merge(track)
+                await session.commit()
+            # searches run between batches, the index must stay consistent
+            for track in tracks:
+                _remove(track.path)
+                _add(track)
+            _sort_tokens()
+        if failed:
+            print(f"Failed to read {failed} library files", file=sys.stderr)
@@ -135,6 +135,7 @@ class Sites(Enum):
     SoundCloud = "SoundCloud"
     Bandcamp = "Bandcamp"
     Custom = "Custom"
+    Local = "Local"
     Unknown = "Unknown"
 
 
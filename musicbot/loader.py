@@ -1,16 +1,24 @@
+import os
+import re
 import sys
+import heapq
 import asyncio
 import threading
+from enum import IntEnum
+from itertools import count
+from functools import partial
+from collections import Counter, OrderedDict
 from urllib.request import urlparse
 from datetime import datetime, timezone
 from concurrent.futures import ProcessPoolExecutor
 from multiprocessing import get_context as mp_context
-from typing import List, Tuple, Optional, Union
+from typing import Callable, Iterable, List, Tuple, Optional, Union
 
 import yt_dlp
 
 from config import config
-from musicbot import linkutils
+from musicbot import library, linkutils
+from musicbot.identities import Identity, IdentityPool, is_throttle_message
 from musicbot.songinfo import Song
 from musicbot.utils import OutputWrapper
 
@@ -32,17 +40,91 @@ class LoaderProcess(_context.Process):
 
 _context.Process = LoaderProcess
 
+WORKERS = 1
+
 _loop = asyncio.new_event_loop()
-_executor = ProcessPoolExecutor(1, _context)
+_executor = ProcessPoolExecutor(WORKERS, _context)
 _cached_downloaders: List[Tuple[dict, yt_dlp.YoutubeDL]] = []
 _preloading = {}
 _search_lock = threading.Lock()
 
+# jobs waiting for a free worker, ordered by priority
+_pending: List[Tuple[int, int, "_Job"]] = []
+_job_counter = count()
+_running_jobs = 0
+# number of jobs that missed their deadline by site
+timeouts = Counter()
+identity_pool = IdentityPool.from_config()
+# options of the identity used by the current job, set in the worker
+_identity_options = {}
+
+# words that mark a different version of the song
+# unless the user searched for them
+VERSION_WORDS = {
+    "8d",
+    "cover",
+    "instrumental",
+    "karaoke",
+    "live",
+    "nightcore",
+    "reaction",
+    "remix",
+    "reverb",
+    "slowed",
+    "sped",
+    "tutorial",
+}
+_word_regex = re.compile(r"\w+")
+# lower is better, others get 3
+CODEC_PREFERENCE = {"opus": 0, "vorbis": 1, "mp4a": 2}
+
+# resolved songs by request string and by webpage url
+_song_cache: "OrderedDict[str, Song]" = OrderedDict()
+
 
 class SongError(Exception):
     pass
 
 
+class LoaderTimeout(SongError):
+    pass
+
+
+class ExtractorThrottled(SongError):
+    pass
+
+
+class Priority(IntEnum):
+    "Jobs with lower values are run first"
+
+    # a song needs to start playing right now
+    PLAYBACK = 0
+    # user is waiting for the command response
+    REQUEST = 1
+    # songs in the queue
+    PRELOAD = 2
+    # startup cache warm-up
+    WARMUP = 3
+
+
+class _Job:
+    def __init__(
+        self, f: Callable, args: tuple, priority: Priority, site: str
+    ):
+        self.f = f
+        self.args = args
+        self.priority = priority
+        self.site = site
+        self.future = asyncio.get_running_loop().create_future()
+        self.deadline = (
+            asyncio.get_running_loop().time()
+            + config.LOADER_TIMEOUTS[priority]
+        )
+        # set when the job is submitted to the worker
+        self.running = False
+        self.attempts = 0
+
+
 def _noop():
     pass
 
@@ -52,7 +134,15 @@ def init():
     _executor.submit(_noop).result()
 
 
+def _run_as(identity_options: dict, f: Callable, *args):
+    "Runs the job in the worker on behalf of the identity"
+    global _identity_options
+    _identity_options = identity_options
+    return f(*args)
+
+
 def extract_info(url: str, options: dict) -> dict:
+    options = {**options, **_identity_options}
     downloader = None
     for o, d in _cached_downloaders:
         if o == options:
@@ -64,20 +154,53 @@ def extract_info(url: str, options: dict) -> dict:
         downloader = yt_dlp.YoutubeDL(options.copy())
         _cached_downloaders.append((options, downloader))
     with _search_lock:
-        return downloader.extract_info(url, False)
+        try:
+            return downloader.extract_info(url, False)
+        except yt_dlp.DownloadError as e:
+            if is_throttle_message(str(e)):
+                # not a DownloadError, nothing should retry it
+                raise ExtractorThrottled(config.SONGINFO_THROTTLED) from None
+            raise
+
+
+def rank_formats(formats: List[dict], bitrate: int) -> List[dict]:
+    """Sorts playable formats from the cheapest to stream and decode
+    without losing quality in a voice channel of given bitrate (kbps)
+    Prefers audio-only, then enough bitrate, then opus, then smaller size"""
+
+    def key(fmt: dict) -> tuple:
+        abr = fmt.get("abr") or fmt.get("tbr")
+        return (
+            fmt.get("vcodec") not in (None, "none"),
+            abr is None or abr < bitrate,
+            CODEC_PREFERENCE.get(fmt["acodec"].partition(".")[0], 3),
+            abs((abr or 0) - bitrate),
+        )
+
+    playable = [
+        fmt
+        for fmt in formats
+        if fmt.get("url")
+        and fmt.get("acodec") not in (None, "none")
+        and fmt.get("protocol", "https") in ("http", "https")
+    ]
+    return sorted(playable, key=key)
 
 
-def fetch_song_info(song: Song) -> bool:
+def fetch_song_info(song: Song, bitrate: Optional[int] = None) -> bool:
     try:
         info = extract_info(
             song.info.webpage_url,
             {
-                "format": "bestaudio",
+                "format": "bestaudio/best",
                 "title": True,
                 "cookiefile": config.COOKIE_PATH,
                 "quiet": True,
             },
         )
+    except ExtractorThrottled:
+        # retried by the scheduler with another identity
+        raise
     except Exception as e:
         if isinstance(e, yt_dlp.DownloadError) and e.exc_info[1].expected:
             return False
@@ -90,34 +213,175 @@ def fetch_song_info(song: Song) -> bool:
             },
         )
     song.update(info)
+    ranked = rank_formats(
+        info.get("formats") or [], bitrate or config.DEFAULT_BITRATE
+    )
+    # kept in case the stream of the selected one breaks
+    song.formats = [
+        {key: fmt.get(key) for key in ("url", "acodec", "format_id")}
+        for fmt in ranked
+    ]
+    song.promote_format()
     return True
 
 
-def search_youtube(title: str) -> Optional[dict]:
+def fetch_with_alternates(song: Song, bitrate: Optional[int] = None) -> bool:
+    """Fetches song info
+    Falls back to the next search candidate if the song is unavailable"""
+    while True:
+        try:
+            if fetch_song_info(song, bitrate):
+                return True
+        except yt_dlp.DownloadError:
+            if not song.alternates:
+                raise
+        if not song.promote_alternate():
+            return False
+
+
+def _words(text: Optional[str]) -> set:
+    return set(_word_regex.findall((text or "").lower()))
+
+
+def rank_candidates(query: str, entries: Iterable[dict]) -> List[dict]:
+    """Sorts search results by how well they match the query
+    Returns song data of the candidates, best first"""
+    query_words = _words(query)
+
+    def score(item: Tuple[int, dict]) -> float:
+        position, entry = item
+        title_words = _words(entry.get("title"))
+        result = len(query_words & title_words) / (len(query_words) or 1)
+        result -= len((title_words & VERSION_WORDS) - query_words)
+        if not entry.get("duration"):
+            # live streams and premieres
+            result -= 1
+        # trust the search engine when everything else is equal
+        return result - position * 0.1
+
+    return [
+        {
+            "webpage_url": f"https://www.youtube.com/watch?v={entry['id']}",
+            "title": entry.get("title"),
+            "uploader": entry.get("channel") or entry.get("uploader"),
+            "duration": entry.get("duration"),
+        }
+        for _, entry in sorted(
+            enumerate(e for e in entries if e.get("id")),
+            key=score,
+            reverse=True,
+        )
+    ]
+
+
+def search_youtube(title: str) -> List[dict]:
     """Searches youtube for the video title
-    Returns the first results video link"""
+    Returns the best matching candidates"""
 
     options = {
-        "format": "bestaudio/best",
+        "extract_flat": True,
         "default_search": "auto",
         "noplaylist": True,
         "cookiefile": config.COOKIE_PATH,
         "quiet": True,
     }
 
-    r = extract_info("ytsearch:" + title, options)
+    r = extract_info(f"ytsearch{config.SEARCH_CANDIDATES}:" + title, options)
 
     if not r:
-        return None
+        return []
 
-    return r["entries"][0]
+    return rank_candidates(title, r["entries"])
 
 
-async def load_song(track: str) -> Union[Optional[Song], List[Song]]:
-    return await _run_sync(_load_song, track)
+def _from_candidates(
+    song: Song, candidates: List[dict], bitrate: Optional[int] = None
+) -> bool:
+    "Resolves the song to the first available search candidate"
+    song.alternates = candidates
+    if not song.promote_alternate():
+        return False
+    return fetch_with_alternates(song, bitrate)
 
 
-def _load_song(track: str) -> Union[Optional[Song], List[Song]]:
+def is_fresh(song: Song) -> bool:
+    "Checks if the song has a stream url that didn't expire yet"
+    if song.base_url is None:
+        return False
+    if song.host not in (linkutils.Sites.YouTube, linkutils.Sites.Spotify):
+        return True
+
+    expire = (
+        ("&" + urlparse(song.base_url).query)
+        .partition("&expire=")[2]
+        .partition("&")[0]
+    )
+    try:
+        expire = int(expire)
+    except ValueError:
+        return True
+    return datetime.now(timezone.utc) < datetime.fromtimestamp(
+        expire, timezone.utc
+    )
+
+
+def _remember(song: Song):
+    "Stores a copy of the resolved song in the cache"
+    cached = Song(song.origin, song.host)
+    cached.update(song)
+    for key in (song.request, song.info.webpage_url):
+        if key is None:
+            continue
+        _song_cache[key] = cached
+        _song_cache.move_to_end(key)
+    while len(_song_cache) > config.SONG_CACHE_SIZE:
+        _song_cache.popitem(last=False)
+
+
+def _recall(key: Optional[str]) -> Optional[Song]:
+    cached = _song_cache.get(key)
+    if cached is not None:
+        _song_cache.move_to_end(key)
+    return cached
+
+
+async def load_song(
+    track: str,
+    priority: Priority = Priority.REQUEST,
+    bitrate: Optional[int] = None,
+) -> Union[Optional[Song], List[Song]]:
+    if (
+        linkutils.identify_url(track) == linkutils.Sites.Unknown
+        and not linkutils.get_urls(track)
+    ):
+        song = library.find(track)
+        if song is not None:
+            song.request = track
+            return song
+
+    cached = _recall(track)
+    if cached is not None:
+        song = Song(linkutils.Origins.Default, cached.host)
+        song.update(cached)
+        song.request = track
+        return song
+
+    loaded = await _run_sync(
+        _load_song,
+        track,
+        bitrate,
+        priority=priority,
+        site=linkutils.identify_url(track).value,
+    )
+    if isinstance(loaded, Song):
+        loaded.request = track
+        _remember(loaded)
+    return loaded
+
+
+def _load_song(
+    track: str, bitrate: Optional[int] = None
+) -> Union[Optional[Song], List[Song]]:
     host = linkutils.identify_url(track)
     is_playlist = linkutils.identify_playlist(track)
 
@@ -125,17 +389,18 @@ def _load_song(track: str) -> Union[Optional[Song], List[Song]]:
         return load_playlist(is_playlist, track)
 
     data = None
+    candidates = None
 
     if host == linkutils.Sites.Unknown:
         if linkutils.get_urls(track):
             return None
 
-        data = search_youtube(track)
+        candidates = search_youtube(track)
         host = linkutils.Sites.YouTube
 
     elif host == linkutils.Sites.Spotify:
         title = _loop.run_until_complete(linkutils.convert_spotify(track))
-        data = search_youtube(title)
+        candidates = search_youtube(title)
 
     elif host == linkutils.Sites.YouTube:
         track = track.split("&list=")[0]
@@ -151,8 +416,11 @@ def _load_song(track: str) -> Union[Optional[Song], List[Song]]:
     song = Song(linkutils.Origins.Default, host, webpage_url=track)
     if data:
         song.update(data)
+    elif candidates is not None:
+        if not _from_candidates(song, candidates, bitrate):
+            raise SongError(config.SONGINFO_ERROR)
     else:
-        if not fetch_song_info(song):
+        if not fetch_song_info(song, bitrate):
             raise SongError(config.SONGINFO_ERROR)
 
     return song
@@ -208,60 +476,168 @@ def load_playlist(
         ]
 
 
-def _preload(song: Song) -> Optional[Song]:
-    if song.host == linkutils.Sites.Spotify:
+def _preload(song: Song, bitrate: Optional[int] = None) -> Optional[Song]:
+    if (
+        linkutils.identify_url(song.info.webpage_url)
+        == linkutils.Sites.Spotify
+    ):
         title = _loop.run_until_complete(
             linkutils.convert_spotify(song.info.webpage_url)
         )
-        data = search_youtube(title)
-        if data:
-            song.update(data)
+        if _from_candidates(song, search_youtube(title), bitrate):
             return song
         else:
             return None
 
-    elif fetch_song_info(song):
+    elif fetch_with_alternates(song, bitrate):
         return song
     return None
 
 
-async def preload(song: Song) -> bool:
-    if song.base_url is not None:
-        if song.host not in (linkutils.Sites.YouTube, linkutils.Sites.Spotify):
-            return True
+async def preload(
+    song: Song,
+    priority: Priority = Priority.PRELOAD,
+    bitrate: Optional[int] = None,
+    refresh: bool = False,
+) -> bool:
+    """Resolves the stream url of the song if it's missing or expired
+    `refresh` resolves it again even if it looks valid"""
+    if song.host == linkutils.Sites.Local:
+        # files don't expire, the file is opened again on refresh
+        return os.path.isfile(song.base_url)
+    if is_fresh(song) and not refresh:
+        return True
 
-        expire = (
-            ("&" + urlparse(song.base_url).query)
-            .partition("&expire=")[2]
-            .partition("&")[0]
-        )
-        try:
-            expire = int(expire)
-        except ValueError:
-            return True
-        if datetime.now(timezone.utc) < datetime.fromtimestamp(
-            expire, timezone.utc
+    if song.info.webpage_url is None:
+        return not refresh
+
+    for key in (song.request, song.info.webpage_url):
+        cached = _recall(key)
+        if (
+            cached is not None
+            # promoted songs differ from what their request resolved to,
+            # the request is remembered again once they are resolved
+            and cached.info.webpage_url == song.info.webpage_url
+            and is_fresh(cached)
+            and not refresh
         ):
+            song.update(cached)
             return True
 
-    if song.info.webpage_url is None:
-        return True
-
     future = _preloading.get(song)
     if future:
         return await future
     _preloading[song] = asyncio.Future()
 
-    preloaded = await _run_sync(_preload, song)
+    try:
+        preloaded = await _run_sync(
+            _preload,
+            song,
+            bitrate,
+            priority=priority,
+            site=song.host.value,
+        )
+    except BaseException:
+        _preloading.pop(song).set_result(False)
+        raise
     success = preloaded is not None
     if success:
         song.update(preloaded)
+        _remember(preloaded)
 
     _preloading.pop(song).set_result(success)
     return success
 
 
-async def _run_sync(f, *args):
-    return await asyncio.get_running_loop().run_in_executor(
-        _executor, f, *args
+async def _run_sync(
+    f,
+    *args,
+    priority: Priority = Priority.REQUEST,
+    site: str = linkutils.Sites.Unknown.value,
+):
+    job = _Job(f, args, priority, site)
+    heapq.heappush(_pending, (priority, next(_job_counter), job))
+    _dispatch()
+    try:
+        return await asyncio.wait_for(
+            job.future, job.deadline - asyncio.get_running_loop().time()
+        )
+    except asyncio.TimeoutError:
+        timeouts[site] += 1
+        print(
+            f"Loader job for {site} timed out"
+            f" ({'running' if job.running else 'queued'})",
+            file=sys.stderr,
+        )
+        if job.running:
+            _recycle_worker()
+        raise LoaderTimeout(config.SONGINFO_TIMEOUT) from None
+
+
+def _dispatch():
+    "Submits the most important pending jobs to the free workers"
+    global _running_jobs
+    while _running_jobs < WORKERS and _pending:
+        _, _, job = heapq.heappop(_pending)
+        if job.future.done():
+            # the caller doesn't wait for it anymore
+            continue
+        identity = identity_pool.acquire()
+        if identity is None:
+            # don't make it worse, wait for the cooldown
+            job.future.set_exception(
+                ExtractorThrottled(config.SONGINFO_THROTTLED)
+            )
+            continue
+        _running_jobs += 1
+        job.running = True
+        job.attempts += 1
+        running = asyncio.wrap_future(
+            _executor.submit(_run_as, identity.options, job.f, *job.args)
+        )
+        running.add_done_callback(partial(_job_done, job, identity))
+
+
+def _job_done(job: _Job, identity: Identity, running: asyncio.Future):
+    global _running_jobs
+    _running_jobs -= 1
+    throttled = not running.cancelled() and isinstance(
+        running.exception(), ExtractorThrottled
+    )
+    identity_pool.release(identity, throttled)
+    future = job.future
+    if future.done():
+        pass
+    elif throttled and job.attempts < len(identity_pool):
+        # try again with another identity
+        job.running = False
+        heapq.heappush(_pending, (job.priority, next(_job_counter), job))
+    elif running.cancelled():
+        future.cancel()
+    elif running.exception() is not None:
+        future.set_exception(running.exception())
+    else:
+        future.set_result(running.result())
+    _dispatch()
+
+
+def _recycle_worker():
+    """Replaces the executor with a fresh one
+    Kills the worker to abandon the stuck job"""
+    global _executor
+    old_executor = _executor
+    _executor = ProcessPoolExecutor(WORKERS, _context)
+    # the stuck job will fail with BrokenProcessPool
+    # and free its slot in _job_done
+    for process in list((old_executor._processes or {}).values()):
+        process.terminate()
+    old_executor.shutdown(wait=False, cancel_futures=True)
+
+
+def stats() -> Optional[str]:
+    "Describes loader jobs that missed their deadline, None if none did"
+    if not timeouts:
+        return None
+    return "timeouts " + ", ".join(
+        f"{site} {count}" for site, count in timeouts.most_common()
     )
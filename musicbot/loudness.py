@@ -0,0 +1,114 @@
+import re
+import sys
+import asyncio
+from typing import TYPE_CHECKING, Dict, Optional, Set
+
+from sqlalchemy import String, select
+from sqlalchemy.orm import Mapped, mapped_column
+
+from config import config
+from musicbot.history import REQUEST_LENGTH
+from musicbot.settings import Base
+from musicbot.songinfo import Song
+from musicbot.sources import before_options
+
+# avoiding circular import
+if TYPE_CHECKING:
+    from musicbot.bot import MusicBot
+
+# dB
+INAUDIBLE_DIFFERENCE = 1
+# the last one is the summary
+LOUDNESS_REGEX = re.compile(r"I:\s+(-?\d+(?:\.\d+)?) LUFS")
+
+# integrated loudness in LUFS by webpage url
+_loudness: Dict[str, float] = {}
+_analyzing: Set[str] = set()
+# analysis downloads the whole track, don't do too much at once
+_analysis_lock = asyncio.Lock()
+
+
+class TrackLoudness(Base):
+    __tablename__ = "track_loudness"
+
+    webpage_url: Mapped[str] = mapped_column(
+        String(REQUEST_LENGTH), primary_key=True
+    )
+    loudness: Mapped[float]
+
+
+async def load(bot: "MusicBot"):
+    "Loads results of previous analyses"
+    async with bot.DbSession() as session:
+        rows = await session.execute(
+            select(TrackLoudness.webpage_url, TrackLoudness.loudness)
+        )
+    _loudness.update(rows.tuples())
+
+
+def gain(song: Song) -> float:
+    """Returns the gain that brings the song to the target loudness
+    1.0 if it wasn't analyzed yet"""
+    loudness = _loudness.get(song.info.webpage_url)
+    if not config.NORMALIZE_LOUDNESS or loudness is None:
+        return 1.0
+    db = min(config.TARGET_LOUDNESS - loudness, config.MAX_LOUDNESS_BOOST)
+    if abs(db) < INAUDIBLE_DIFFERENCE:
+        # keep opus passthrough possible
+        return 1.0
+    return 10 ** (db / 20)
+
+
+async def measure(url: str) -> Optional[float]:
+    "Runs EBU R128 analysis of the stream in FFmpeg"
+    process = await asyncio.create_subprocess_exec(
+        "ffmpeg",
+        "-hide_banner",
+        "-nostats",
+        *before_options(url).split(),
+        "-i",
+        url,
+        "-vn",
+        "-af",
+        "ebur128",
+        "-f",
+        "null",
+        "-",
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    _, output = await process.communicate()
+    results = LOUDNESS_REGEX.findall(output.decode(errors="replace"))
+    if process.returncode != 0 or not results:
+        return None
+    return float(results[-1])
+
+
+async def analyze(bot: "MusicBot", song: Song):
+    "Measures loudness of the song once and remembers it"
+    key = song.info.webpage_url
+    if (
+        not config.NORMALIZE_LOUDNESS
+        or key is None
+        or len(key) > REQUEST_LENGTH
+        or key in _loudness
+        or key in _analyzing
+        or song.base_url is None
+    ):
+        return
+    _analyzing.add(key)
+    try:
+        async with _analysis_lock:
+            loudness = await measure(song.base_url)
+        if loudness is None:
+            print(f"Failed to measure loudness of {key}", file=sys.stderr)
+            return
+        _loudness[key] = loudness
+        async with bot.DbSession() as session:
+            await session.merge(
+                TrackLoudness(webpage_url=key, loudness=loudness)
+            )
+            await session.commit()
+    finally:
+        _analyzing.discard(key)
@@ -0,0 +1,204 @@
+import os
+import sys
+import mmap
+import struct
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional, Set
+
+import discord
+
+from config import config
+from musicbot.songinfo import Song
+from musicbot.sources import FRAME_LENGTH
+
+# every packet is prefixed with its length
+HEADER = struct.Struct("<H")
+EXTENSION = ".packets"
+# recordings are renamed once they are complete
+PART_EXTENSION = EXTENSION + ".part"
+# seconds of a recording that may be missing at the end
+DURATION_TOLERANCE = 2
+
+# file sizes by key, least recently used first
+_index: "OrderedDict[str, int]" = OrderedDict()
+_total_size = 0
+_recording: Set[str] = set()
+# recordings finish in player threads
+_lock = threading.Lock()
+
+
+def _key(song: Song) -> Optional[str]:
+    if song.info.webpage_url is None:
+        return None
+    return hashlib.sha256(song.info.webpage_url.encode()).hexdigest()
+
+
+def _is_key(name: str) -> bool:
+    return len(name) == 64 and all(c in "0123456789abcdef" for c in name)
+
+
+def _path(key: str, extension: str = EXTENSION) -> str:
+    return os.path.join(config.PACKET_CACHE_DIR, key + extension)
+
+
+def _max_size() -> int:
+    return config.PACKET_CACHE_SIZE * 1024 * 1024
+
+
+def load():
+    "Indexes packet files left from previous runs"
+    global _total_size
+    os.makedirs(config.PACKET_CACHE_DIR, exist_ok=True)
+    files = []
+    for entry in os.scandir(config.PACKET_CACHE_DIR):
+        # the directory may be shared, other files are left alone
+        if not entry.is_file(follow_symlinks=False):
+            continue
+        if entry.name.endswith(PART_EXTENSION) and _is_key(
+            entry.name[: -len(PART_EXTENSION)]
+        ):
+            # interrupted recording
+            try:
+                os.remove(entry.path)
+            except OSError as e:
+                print("Failed to remove a recording:", e, file=sys.stderr)
+            continue
+        key = entry.name[: -len(EXTENSION)]
+        if not entry.name.endswith(EXTENSION) or not _is_key(key):
+            continue
+        stat = entry.stat()
+        files.append((stat.st_mtime, key, stat))
+    with _lock:
+        for _, key, stat in sorted(files):
+            _index[key] = stat.st_size
+            _total_size += stat.st_size
+        _evict()
+
+
+def _evict():
+    "Removes least recently used files until the cache fits, needs _lock"
+    global _total_size
+    while _total_size > _max_size() and _index:
+        key, size = _index.popitem(last=False)
+        _total_size -= size
+        try:
+            os.remove(_path(key))
+        except OSError as e:
+            print("Failed to evict cached packets:", e, file=sys.stderr)
+
+
+def get(song: Song) -> Optional["CachedOpusAudio"]:
+    "Returns source reading cached packets of the song, if there are some"
+    key = _key(song)
+    if not config.PACKET_CACHE_SIZE or key is None:
+        return None
+    with _lock:
+        if key not in _index:
+            return None
+        _index.move_to_end(key)
+    path = _path(key)
+    try:
+        # keep recency across restarts
+        os.utime(path)
+        return CachedOpusAudio(path)
+    except (OSError, ValueError) as e:
+        print("Failed to open cached packets:", e, file=sys.stderr)
+        return None
+
+
+def recorder(song: Song) -> Optional["Recorder"]:
+    "Returns recorder for the packets of the song if it should be cached"
+    key = _key(song)
+    if (
+        not config.PACKET_CACHE_SIZE
+        or key is None
+        # live streams and unknown files
+        or not song.info.duration
+    ):
+        return None
+    with _lock:
+        if key in _index or key in _recording:
+            return None
+        _recording.add(key)
+    try:
+        return Recorder(key, song.info.duration)
+    except OSError as e:
+        print("Failed to start recording packets:", e, file=sys.stderr)
+        with _lock:
+            _recording.discard(key)
+        return None
+
+
+class Recorder:
+    """Writes packets of the played track to a temporary file,
+    it's added to the cache if the whole track was played"""
+
+    def __init__(self, key: str, duration: float):
+        self.key = key
+        self.duration = duration
+        self.packets = 0
+        self._temp_path = _path(key, PART_EXTENSION)
+        self._file = open(self._temp_path, "wb")
+
+    def write(self, packet: bytes):
+        self._file.write(HEADER.pack(len(packet)))
+        self._file.write(packet)
+        self.packets += 1
+
+    def finish(self):
+        "Adds the recording to the cache if it's complete"
+        if self.packets * FRAME_LENGTH < self.duration - DURATION_TOLERANCE:
+            # the stream has failed in the middle
+            self.abort()
+            return
+        global _total_size
+        self._file.close()
+        size = os.path.getsize(self._temp_path)
+        os.replace(self._temp_path, _path(self.key))
+        with _lock:
+            _recording.discard(self.key)
+            _index[self.key] = size
+            _total_size += size
+            _evict()
+
+    def abort(self):
+        self._file.close()
+        try:
+            os.remove(self._temp_path)
+        except OSError:
+            pass
+        with _lock:
+            _recording.discard(self.key)
+
+
+class CachedOpusAudio(discord.AudioSource):
+    "Reads opus packets from a memory-mapped cache file"
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._offset = 0
+
+    def is_opus(self) -> bool:
+        return True
+
+    def read(self) -> bytes:
+        if self._offset >= len(self._map):
+            return b""
+        (size,) = HEADER.unpack_from(self._map, self._offset)
+        start = self._offset + HEADER.size
+        self._offset = start + size
+        return self._map[start : self._offset]
+
+    def skip(self, packets: int):
+        "Moves forward by the number of packets"
+        for _ in range(packets):
+            if self._offset >= len(self._map):
+                return
+            (size,) = HEADER.unpack_from(self._map, self._offset)
+            self._offset += HEADER.size + size
+
+    def cleanup(self):
+        self._map.close()
@@ -78,6 +78,18 @@ class Playlist:
 
         return self.playque[0]
 
+    def peek_next(self) -> Optional[Song]:
+        "Returns the song next() would return when a song ends by itself"
+        if len(self.playque) == 0:
+            return None
+        if self.loop == LoopMode.SINGLE:
+            return self.playque[0]
+        if len(self.playque) > 1:
+            return self.playque[1]
+        if self.loop == LoopMode.ALL:
+            return self.playque[0]
+        return None
+
     def prev(self) -> Optional[Song]:
         if self.loop != LoopMode.ALL:
             if len(self.playhistory) != 0:
@@ -0,0 +1,212 @@
+import os
+import sys
+import time
+import asyncio
+import weakref
+import threading
+from collections import Counter, deque
+from typing import TYPE_CHECKING, Deque, Optional, Set, Tuple
+
+import discord
+
+from config import config
+
+# avoiding circular import
+if TYPE_CHECKING:
+    from musicbot.bot import MusicBot
+
+# seconds a process may run while its guild plays nothing
+ORPHAN_TIMEOUT = 30
+# waits for admission to remember
+WAIT_HISTORY = 100
+
+try:
+    _CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+    _PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+except (AttributeError, ValueError):
+    # usage is read from /proc, not available anyway
+    _CLOCK_TICKS = _PAGE_SIZE = 0
+
+
+class Process:
+    """FFmpeg process of one source
+
+    Attributes:
+        guild_id: Guild the source plays in, None if it's shared.
+        pid: Process id, None until an encoding worker running it
+            reports it.
+        idle_since: When its guild was last seen playing nothing.
+    """
+
+    def __init__(self, source: discord.AudioSource, guild_id: Optional[int]):
+        self.guild_id = guild_id
+        process = getattr(source, "_process", None)
+        self.pid: Optional[int] = getattr(process, "pid", None)
+        self.source = weakref.ref(source)
+        self.idle_since: Optional[float] = None
+        self.cpu_time = 0.0
+
+    def usage(self) -> Tuple[float, int]:
+        "Returns seconds of CPU time and bytes of RSS, zeros if unknown"
+        if self.pid is None:
+            # encoding workers start FFmpeg after the source is registered
+            self.pid = getattr(self.source(), "pid", None)
+        if self.pid is None or not _CLOCK_TICKS:
+            return self.cpu_time, 0
+        try:
+            with open(f"/proc/{self.pid}/stat") as file:
+                # the name in parentheses may contain spaces
+                fields = file.read().rpartition(")")[2].split()
+            with open(f"/proc/{self.pid}/statm") as file:
+                resident = int(file.read().split()[1])
+        except (OSError, IndexError, ValueError):
+            return self.cpu_time, 0
+        # utime and stime are the 14th and 15th field
+        self.cpu_time = (int(fields[11]) + int(fields[12])) / _CLOCK_TICKS
+        return self.cpu_time, resident * _PAGE_SIZE
+
+
+_processes: Set[Process] = set()
+# CPU time of ended processes by guild id
+_cpu_time_ended = Counter()
+# sources are cleaned up in player threads
+_lock = threading.Lock()
+_waiters: Deque[asyncio.Future] = deque()
+_loop: Optional[asyncio.AbstractEventLoop] = None
+waits: Deque[float] = deque(maxlen=WAIT_HISTORY)
+reaped = 0
+
+
+def _is_full() -> bool:
+    return 0 < config.MAX_FFMPEG_PROCESSES <= len(_processes)
+
+
+def _wake_next():
+    "Lets the first waiting stream start, runs in the event loop"
+    while _waiters and not _is_full():
+        waiter = _waiters.popleft()
+        if not waiter.done():
+            waiter.set_result(None)
+            return
+
+
+async def admit():
+    """Waits until a new stream may start FFmpeg
+    Streams start in the order they came, the process
+    must be registered before the next await"""
+    global _loop
+    _loop = asyncio.get_running_loop()
+    if not _waiters and not _is_full():
+        return
+    started = time.perf_counter()
+    waiter = _loop.create_future()
+    _waiters.append(waiter)
+    try:
+        await waiter
+        while _is_full():
+            # a replacement took the slot, stay first in line
+            waiter = _loop.create_future()
+            _waiters.appendleft(waiter)
+            await waiter
+    finally:
+        if waiter in _waiters:
+            _waiters.remove(waiter)
+        # pass the slot on if this one was cancelled
+        _wake_next()
+    waits.append(time.perf_counter() - started)
+
+
+def register(
+    source: discord.AudioSource, guild_id: Optional[int]
+) -> Process:
+    "Accounts FFmpeg process of the source to the guild"
+    process = Process(source, guild_id)
+    with _lock:
+        _processes.add(process)
+    return process
+
+
+def unregister(process: Process):
+    "Called before the process is killed, lets a waiting stream start"
+    cpu_time, _ = process.usage()
+    with _lock:
+        if process not in _processes:
+            return
+        _processes.remove(process)
+        _cpu_time_ended[process.guild_id] += cpu_time
+    if _loop is not None and not _loop.is_closed():
+        _loop.call_soon_threadsafe(_wake_next)
+
+
+def _is_orphan(bot: "MusicBot", process: Process, now: float) -> bool:
+    if process.guild_id is None:
+        # broadcasts end by themselves
+        return False
+    guild = bot.get_guild(process.guild_id)
+    voice_client = guild and guild.voice_client
+    if voice_client and (
+        voice_client.is_playing() or voice_client.is_paused()
+    ):
+        process.idle_since = None
+        return False
+    if process.idle_since is None:
+        process.idle_since = now
+    return now - process.idle_since > ORPHAN_TIMEOUT
+
+
+async def reap(bot: "MusicBot"):
+    """Kills processes left behind by players that failed,
+    forgets processes that ended without cleanup"""
+    global reaped
+    now = time.monotonic()
+    with _lock:
+        processes = list(_processes)
+    for process in processes:
+        source = process.source()
+        if source is None:
+            # collected, its process was killed
+            unregister(process)
+        elif _is_orphan(bot, process, now):
+            print(
+                f"Killing FFmpeg process {process.pid} left playing nothing",
+                file=sys.stderr,
+            )
+            reaped += 1
+            # killing waits for the process
+            await bot.loop.run_in_executor(None, source.cleanup)
+            # in case cleanup of the source doesn't unregister it
+            unregister(process)
+
+
+def guild_stats(guild_id: int) -> Optional[str]:
+    "Describes FFmpeg processes of the guild, None if it had none"
+    with _lock:
+        processes = [p for p in _processes if p.guild_id == guild_id]
+        ended = _cpu_time_ended.get(guild_id)
+    if not processes and ended is None:
+        return None
+    usage = [p.usage() for p in processes]
+    return "{} FFmpeg processes, {:.1f} s CPU, {:.1f} MB RSS".format(
+        len(processes),
+        sum(cpu for cpu, _ in usage) + (ended or 0.0),
+        sum(rss for _, rss in usage) / 1024 / 1024,
+    )
+
+
+def stats() -> str:
+    with _lock:
+        processes = list(_processes)
+        ended = sum(_cpu_time_ended.values())
+    usage = [p.usage() for p in processes]
+    return (
+        "{} processes, limit {}, {} waiting, {:.1f} s CPU, {:.1f} MB RSS,"
+        " {} orphans killed{}".format(
+            len(processes),
+            config.MAX_FFMPEG_PROCESSES or "none",
+            len(_waiters),
+            sum(cpu for cpu, _ in usage) + ended,
+            sum(rss for _, rss in usage) / 1024 / 1024,
+            reaped,
+            ", max wait {:.1f} s".format(max(waits)) if waits else "",
+        )
+    )
@@ -0,0 +1,350 @@
+import sys
+import time
+import asyncio
+import threading
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Deque, List, Optional, Tuple
+
+import discord
+from discord import opus
+
+from config import config
+from musicbot.voice import VoiceClient
+
+DELAY = opus.Encoder.FRAME_LENGTH / 1000
+# frames sent later than this after their tick are deadline misses
+MISS_THRESHOLD = DELAY
+# resynchronize instead of sending a burst after a long stall
+MAX_LAG = 5 * DELAY
+
+_scheduler: Optional["Scheduler"] = None
+_scheduler_lock = threading.Lock()
+# reads wait for FFmpeg, a stalled stream shouldn't hold the tick
+_readers: Optional[ThreadPoolExecutor] = None
+# cleanup kills FFmpeg and after callbacks may block
+_finisher = ThreadPoolExecutor(1, thread_name_prefix="player cleanup")
+
+
+class BufferStats:
+    """Jitter buffer counters of one voice client
+
+    Attributes:
+        frames: Number of packets sent.
+        late: Number of packets sent later than MISS_THRESHOLD.
+        underruns: Number of ticks the buffer was empty.
+        depth: Sum of buffered packets at every sent packet.
+    """
+
+    def __init__(self):
+        self.frames = 0
+        self.late = 0
+        self.underruns = 0
+        self.depth = 0
+
+    def __str__(self):
+        return (
+            "{} frames, {} late, {} underruns, average buffer {:.1f}".format(
+                self.frames,
+                self.late,
+                self.underruns,
+                self.depth / self.frames if self.frames else 0,
+            )
+        )
+
+
+class ScheduledPlayer:
+    """Plays a source on a shared scheduler tick
+    Stands in for discord.player.AudioPlayer in the voice client"""
+
+    def __init__(
+        self,
+        source: discord.AudioSource,
+        client: "ScheduledVoiceClient",
+        *,
+        after: Optional[Callable[[Optional[Exception]], Any]] = None,
+    ):
+        self.source = source
+        self.client = client
+        self.after = after
+        self._end = threading.Event()
+        self._resumed = threading.Event()
+        self._resumed.set()
+        self._lock = threading.Lock()
+        self._current_error: Optional[Exception] = None
+        # encoded ahead by the readers, sent one per tick
+        self._buffer: Deque[bytes] = deque()
+        self.preparing = False
+        # sending starts when the buffer is full for the first time
+        self.started = False
+        # set when the source has ended, the buffer is sent to the end
+        self.drained = False
+        self.stats: BufferStats = client.buffer_stats
+
+    def ready(self) -> bool:
+        return (
+            not self._end.is_set()
+            and self._resumed.is_set()
+            and self.client._connected.is_set()
+        )
+
+    def needs_packets(self) -> bool:
+        return len(self._buffer) < config.AUDIO_BUFFER_FRAMES
+
+    def send(self) -> bool:
+        "Sends the next buffered packet, returns False if there was none"
+        if not self.started:
+            if self.needs_packets() and not self.drained:
+                return False
+            self.started = True
+        try:
+            packet = self._buffer.popleft()
+        except IndexError:
+            if self.drained:
+                self.stop()
+            return False
+        self.stats.frames += 1
+        self.stats.depth += len(self._buffer)
+        try:
+            self.client.send_audio_packet(
+                packet, encode=not self.source.is_opus()
+            )
+        except Exception as e:
+            self._fail(e)
+        return True
+
+    def prepare(self):
+        "Fills the buffer, runs in a reader thread"
+        try:
+            while (
+                self.needs_packets()
+                and not self.drained
+                and not self._end.is_set()
+            ):
+                with self._lock:
+                    data = self.source.read()
+                    if not data:
+                        self.drained = True
+                        return
+                    # under the lock, the source could be replaced
+                    self._buffer.append(data)
+        except Exception as e:
+            self._fail(e)
+        finally:
+            self.preparing = False
+
+    def _fail(self, error: Exception):
+        self._current_error = error
+        self.stop()
+
+    def finish(self):
+        "Called once the scheduler has dropped the player"
+        try:
+            self.source.cleanup()
+        finally:
+            self._call_after()
+
+    def _call_after(self):
+        error = self._current_error
+        if self.after is not None:
+            try:
+                self.after(error)
+            except Exception as e:
+                e.__context__ = error
+                traceback.print_exception(type(e), e, e.__traceback__)
+        elif error:
+            print("Exception in scheduled player", file=sys.stderr)
+            traceback.print_exception(type(error), error, error.__traceback__)
+
+    def stop(self):
+        self._end.set()
+        self._resumed.set()
+        self._speak(False)
+
+    def pause(self, *, update_speaking: bool = True):
+        self._resumed.clear()
+        if update_speaking:
+            self._speak(False)
+
+    def resume(self, *, update_speaking: bool = True):
+        self._resumed.set()
+        if update_speaking:
+            self._speak(True)
+
+    def is_playing(self) -> bool:
+        return self._resumed.is_set() and not self._end.is_set()
+
+    def is_paused(self) -> bool:
+        return not self._end.is_set() and not self._resumed.is_set()
+
+    def _set_source(self, source: discord.AudioSource):
+        with self._lock:
+            self.source = source
+            self._buffer.clear()
+            self.drained = False
+
+    def _speak(self, speaking: bool):
+        try:
+            asyncio.run_coroutine_threadsafe(
+                self.client.ws.speak(speaking), self.client.loop
+            )
+        except Exception as e:
+            print("Speaking call in player failed:", e, file=sys.stderr)
+
+
+class Scheduler(threading.Thread):
+    """Drives all players on one 20 ms tick
+    Every tick sends a buffered packet of every player first, then has
+    the buffers refilled in the reader pool, so the send time doesn't
+    depend on how long reading and encoding takes
+
+    Attributes:
+        frames: Number of packets sent.
+        misses: Number of packets sent later than MISS_THRESHOLD
+            or missing from the buffer.
+    """
+
+    def __init__(self):
+        super().__init__(name="audio scheduler", daemon=True)
+        self._players: List[ScheduledPlayer] = []
+        self._added: List[ScheduledPlayer] = []
+        self._wakeup = threading.Event()
+        self.frames = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._players) + len(self._added)
+
+    def add(self, player: ScheduledPlayer):
+        player._speak(True)
+        # list operations are atomic
+        self._added.append(player)
+        self._wakeup.set()
+
+    def run(self):
+        start = time.perf_counter()
+        tick = 0
+        while True:
+            if not self._players and not self._added:
+                self._wakeup.wait()
+                start = time.perf_counter()
+                tick = 0
+            self._wakeup.clear()
+            while self._added:
+                self._players.append(self._added.pop())
+
+            deadline = start + tick * DELAY
+            for player in self._players:
+                if not player.ready():
+                    continue
+                if player.send():
+                    self.frames += 1
+                    if time.perf_counter() - deadline > MISS_THRESHOLD:
+                        self.misses += 1
+                        player.stats.late += 1
+                elif player.started and not player.drained:
+                    # the readers didn't keep up
+                    self.misses += 1
+                    player.stats.underruns += 1
+
+            active = []
+            reads = []
+            for player in self._players:
+                if player._end.is_set():
+                    _finisher.submit(player.finish)
+                    continue
+                if (
+                    player.ready()
+                    and player.needs_packets()
+                    and not player.drained
+                    and not player.preparing
+                ):
+                    player.preparing = True
+                    reads.append(player)
+                active.append(player)
+            self._players = active
+            # one task per reader thread keeps the overhead per tick low
+            batches = config.AUDIO_READER_THREADS
+            for i in range(min(batches, len(reads))):
+                _readers.submit(_prepare_all, reads[i::batches])
+
+            tick += 1
+            delay = start + tick * DELAY - time.perf_counter()
+            if delay < -MAX_LAG:
+                start = time.perf_counter()
+                tick = 0
+            elif delay > 0:
+                time.sleep(delay)
+
+
+def _prepare_all(players: List[ScheduledPlayer]):
+    for player in players:
+        player.prepare()
+
+
+def get_scheduler() -> Scheduler:
+    "Returns the scheduler, starting it on the first use"
+    global _scheduler, _readers
+    with _scheduler_lock:
+        if _scheduler is None:
+            _readers = ThreadPoolExecutor(
+                config.AUDIO_READER_THREADS, thread_name_prefix="audio reader"
+            )
+            _scheduler = Scheduler()
+            _scheduler.start()
+        return _scheduler
+
+
+def counters() -> Tuple[int, int]:
+    "Returns the number of packets sent and sent late so far"
+    if _scheduler is None:
+        return 0, 0
+    return _scheduler.frames, _scheduler.misses
+
+
+def stats() -> Optional[str]:
+    if _scheduler is None:
+        return None
+    return "{} streams, {} of {} frames late".format(
+        len(_scheduler), _scheduler.misses, _scheduler.frames
+    )
+
+
+class ScheduledVoiceClient(VoiceClient):
+    """Voice client that plays on a shared scheduler instead of own thread
+
+    Attributes:
+        buffer_stats: Jitter buffer counters of all played sources.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buffer_stats = BufferStats()
+
+    @property
+    def buffered(self) -> int:
+        "Number of packets read but not sent yet"
+        player = self._player
+        return len(player._buffer) if player else 0
+
+    def play(
+        self,
+        source: discord.AudioSource,
+        *,
+        after: Optional[Callable[[Optional[Exception]], Any]] = None,
+    ):
+        if not self.is_connected():
+            raise discord.ClientException("Not connected to voice.")
+        if self.is_playing():
+            raise discord.ClientException("Already playing audio.")
+        if not isinstance(source, discord.AudioSource):
+            raise TypeError(
+                "source must be an AudioSource not "
+                + source.__class__.__name__
+            )
+        if not self.encoder and not source.is_opus():
+            self.encoder = opus.Encoder()
+
+        self._player = ScheduledPlayer(source, self, after=after)
+        get_scheduler().add(self._player)
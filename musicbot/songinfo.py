@@ -1,5 +1,6 @@
 import datetime
-from typing import Optional, Union
+from copy import copy
+from typing import List, Optional, Union
 
 import discord
 from config import config
@@ -21,6 +22,17 @@ class Song:
         self.host = host
         self.origin = origin
         self.base_url = base_url
+        # audio codec and format of the stream at base_url
+        self.codec: Optional[str] = None
+        self.format_id: Optional[str] = None
+        # other formats of the same extraction, best first
+        self.formats: List[dict] = []
+        # the string this song was requested with, kept for the history
+        self.request = webpage_url
+        # other search results to try if this one can't be played
+        self.alternates: List[dict] = []
+        # play along with other guilds instead of from the start
+        self.broadcast = False
         self.info = self.Sinfo(
             uploader, title, duration, webpage_url, thumbnail
         )
@@ -71,10 +83,18 @@ class Song:
     def update(self, data: Union[dict, "Song"]):
         if isinstance(data, Song):
             self.base_url = data.base_url
-            self.info = data.info
+            self.codec = data.codec
+            self.format_id = data.format_id
+            self.formats = list(data.formats)
+            self.alternates = list(data.alternates)
+            # don't share info between songs, it may be updated in place
+            self.info = copy(data.info)
             return
 
         self.base_url = data.get("url")
+        self.codec = data.get("acodec")
+        self.format_id = data.get("format_id")
+        self.formats = []
         self.info.uploader = data.get("uploader")
         self.info.title = data.get("title")
         self.info.duration = data.get("duration")
@@ -83,3 +103,22 @@ class Song:
         if thumbnails:
             # last thumbnail has the best resolution
             self.info.thumbnail = thumbnails[-1]["url"]
+
+    def promote_format(self) -> bool:
+        """Switches the stream to the next format
+        Returns False if there are no formats left"""
+        if not self.formats:
+            return False
+        fmt = self.formats.pop(0)
+        self.base_url = fmt["url"]
+        self.codec = fmt["acodec"]
+        self.format_id = fmt.get("format_id")
+        return True
+
+    def promote_alternate(self) -> bool:
+        """Replaces the song with the next search candidate
+        Returns False if there are no candidates left"""
+        if not self.alternates:
+            return False
+        self.update(self.alternates.pop(0))
+        return True
@@ -0,0 +1,555 @@
+import sys
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Callable, Deque, Optional
+
+import discord
+from discord.opus import Decoder, Encoder
+
+from config import config
+from musicbot import dsp, encoding, processes, streamproxy
+from musicbot.songinfo import Song
+
+# avoiding circular import
+if TYPE_CHECKING:
+    from musicbot.packetcache import Recorder
+
+FFMPEG_BEFORE_OPTIONS = (
+    "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5"
+)
+FFMPEG_OPTIONS = "-loglevel error"
+# seconds of audio in one frame
+FRAME_LENGTH = Encoder.FRAME_LENGTH / 1000
+OPUS_SILENCE = b"\xf8\xff\xfe"
+# tracks ending sooner than this before the song duration are broken
+EARLY_END_TOLERANCE = 5
+# sound effects playing over the music at once
+MAX_OVERLAYS = 8
+
+# killing FFmpeg waits for it, replaced tracks are cleaned up here
+_cleaner = ThreadPoolExecutor(1, thread_name_prefix="track cleanup")
+
+
+def can_passthrough(song: Song) -> bool:
+    "Checks if packets of the song can be sent without re-encoding"
+    return config.ENABLE_OPUS_PASSTHROUGH and song.codec == "opus"
+
+
+def before_options(url: str) -> str:
+    "Returns FFmpeg input options, reconnecting only applies to streams"
+    if url.startswith(("http://", "https://")):
+        return FFMPEG_BEFORE_OPTIONS
+    # FFmpeg fails on options the input doesn't know
+    return ""
+
+
+class _Accounted:
+    "Stops accounting the FFmpeg process once the source is cleaned up"
+
+    accounting: Optional[processes.Process] = None
+
+    def cleanup(self):
+        if self.accounting is not None:
+            processes.unregister(self.accounting)
+            self.accounting = None
+        super().cleanup()
+
+
+class _AccountedPCMAudio(_Accounted, discord.FFmpegPCMAudio):
+    pass
+
+
+class _AccountedOpusAudio(_Accounted, discord.FFmpegOpusAudio):
+    pass
+
+
+class _AccountedRemoteTrack(_Accounted, encoding.RemoteTrack):
+    pass
+
+
+def _account(source: _Accounted, guild_id: Optional[int]) -> _Accounted:
+    source.accounting = processes.register(source, guild_id)
+    return source
+
+
+def open_track(
+    song: Song,
+    passthrough: bool = False,
+    start: float = 0.0,
+    guild_id: Optional[int] = None,
+) -> discord.AudioSource:
+    """Starts FFmpeg for the song, accounted to the guild
+    Returns opus source if `passthrough` is set, PCM source
+    or a track encoded in a worker process otherwise"""
+    url = streamproxy.url_for(song)
+    options = before_options(url)
+    if start:
+        options += f" -ss {start:.2f}"
+    if passthrough:
+        track = _AccountedOpusAudio(
+            url,
+            codec="opus",
+            before_options=options,
+            options=FFMPEG_OPTIONS,
+            stderr=sys.stderr,
+        )
+    # crossfade mixes PCM of both songs in this process
+    elif config.ENCODER_PROCESSES and not config.CROSSFADE:
+        track = _AccountedRemoteTrack(url, options, FFMPEG_OPTIONS)
+    else:
+        track = _AccountedPCMAudio(
+            url,
+            before_options=options,
+            options=FFMPEG_OPTIONS,
+            stderr=sys.stderr,
+        )
+    return _account(track, guild_id)
+
+
+def open_overlay(url: str, guild_id: int) -> discord.AudioSource:
+    "Starts FFmpeg for a sound played over the music"
+    overlay = _AccountedPCMAudio(
+        url,
+        before_options=FFMPEG_BEFORE_OPTIONS,
+        options=FFMPEG_OPTIONS,
+        stderr=sys.stderr,
+    )
+    return _account(overlay, guild_id)
+
+
+class _Replaced(Exception):
+    "The track was replaced while it was read"
+
+
+class QueuedTrack:
+    "Track opened in advance to start right after the current one"
+
+    def __init__(
+        self,
+        track: discord.AudioSource,
+        song: Song,
+        gain: float,
+        fade_at: Optional[float],
+        recorder: Optional["Recorder"],
+    ):
+        self.track = track
+        self.song = song
+        self.gain = gain
+        self.fade_at = fade_at
+        self.recorder = recorder
+        # read while fading in, before the switch
+        self.frames = 0
+
+
+class PlaybackSource(discord.AudioSource):
+    """Source that is played by the voice client
+    Encodes PCM tracks and passes opus tracks through,
+    so the track can be replaced without restarting the player
+
+    The next song can be queued in advance, then it starts in the frame
+    where the current one ends, or fades in over the end of it.
+
+    Attributes:
+        track: The source of the current song.
+        gain: Loudness correction of the song, applied with volume.
+        start: Position in seconds where the track started.
+        frames: Number of frames read since the start.
+        last_frame_at: perf_counter() time of the last frame read.
+        gaps: Seconds of silence between songs are appended here.
+        restarts: Seconds from replacing the track to its first frame
+            are appended here.
+        on_switch: Called from the player thread with the queued song
+            when it starts playing.
+        recorder: Saves packets of the current track for the packet cache,
+            dropped if the track is not played whole and unchanged.
+        duration: Expected seconds of the current song.
+        on_broken: Called from the player thread with the position
+            when the track ends before the duration. Silence is played
+            until the track is replaced, recovery is abandoned
+            or RECOVERY_TIMEOUT passes.
+        encoder_settings: Settings of the encoders of PCM tracks,
+            None for the defaults.
+    """
+
+    def __init__(
+        self,
+        track: discord.AudioSource,
+        volume: float,
+        start: float = 0.0,
+        gain: float = 1.0,
+        *,
+        gaps: Optional[Deque[float]] = None,
+        restarts: Optional[Deque[float]] = None,
+        previous_frame_at: Optional[float] = None,
+        on_switch: Optional[Callable[[Song], None]] = None,
+        recorder: Optional["Recorder"] = None,
+        duration: Optional[float] = None,
+        on_broken: Optional[Callable[[float], None]] = None,
+        encoder_settings: Optional[encoding.EncoderSettings] = None,
+    ):
+        self._lock = threading.Lock()
+        self._volume = volume
+        self._encoder: Optional[Encoder] = None
+        self._encoder_settings = encoder_settings
+        self._next: Optional[QueuedTrack] = None
+        self.gain = gain
+        self.track = self._wrap(track, gain)
+        self.start = start
+        self.frames = 0
+        self.gaps = gaps
+        self.restarts = restarts
+        self._replaced_at: Optional[float] = None
+        self.on_switch = on_switch
+        self.recorder = self._recordable(self.track, recorder)
+        self.duration = duration
+        self.on_broken = on_broken
+        # perf_counter() time the track broke at, while recovering
+        self._broken_at: Optional[float] = None
+        self._recovery_abandoned = False
+        self._mixer: Optional[dsp.OverlayMixer] = None
+        # decodes passthrough packets while overlays play
+        self._decoder: Optional[Decoder] = None
+        self.last_frame_at = previous_frame_at
+        self._measure_gap = previous_frame_at is not None
+
+    def _wrap(
+        self, track: discord.AudioSource, gain: float
+    ) -> discord.AudioSource:
+        if isinstance(track, encoding.RemoteTrack):
+            track.volume = self._volume * gain
+            track.settings = self._encoder_settings
+            return track
+        if track.is_opus():
+            return track
+        self._create_encoder()
+        return dsp.process_pcm(track, self._volume * gain)
+
+    def _recordable(
+        self, track: discord.AudioSource, recorder: Optional["Recorder"]
+    ) -> Optional["Recorder"]:
+        "Returns the recorder if packets of the track may be cached"
+        if recorder is None or self._is_passthrough(track):
+            return recorder
+        if encoding.is_default(self._encoder_settings):
+            return recorder
+        recorder.abort()
+        return None
+
+    def _create_encoder(self):
+        if self._encoder is None:
+            self._encoder = Encoder()
+            if self._encoder_settings:
+                encoding.configure(self._encoder, self._encoder_settings)
+
+    @property
+    def encoder_settings(self) -> Optional[encoding.EncoderSettings]:
+        return self._encoder_settings
+
+    @encoder_settings.setter
+    def encoder_settings(self, value: Optional[encoding.EncoderSettings]):
+        with self._lock:
+            self._encoder_settings = value
+            if self._encoder:
+                encoding.configure(
+                    self._encoder, value or encoding.DEFAULT_SETTINGS
+                )
+            for track in (self.track, self._next and self._next.track):
+                if isinstance(track, encoding.RemoteTrack):
+                    track.settings = value
+            # encoded packets would be cached with lowered quality
+            self.recorder = self._recordable(self.track, self.recorder)
+            if self._next:
+                self._next.recorder = self._recordable(
+                    self._next.track, self._next.recorder
+                )
+
+    @staticmethod
+    def _is_passthrough(track: discord.AudioSource) -> bool:
+        return track.is_opus() and not isinstance(
+            track, encoding.RemoteTrack
+        )
+
+    @property
+    def passthrough(self) -> bool:
+        "Tells if the track ignores volume"
+        return self._is_passthrough(self.track)
+
+    @property
+    def position(self) -> float:
+        "Seconds of the song played so far"
+        return self.start + self.frames * FRAME_LENGTH
+
+    @property
+    def volume(self) -> float:
+        return self._volume
+
+    @volume.setter
+    def volume(self, value: float):
+        self._volume = value
+        if value * self.gain != 1.0:
+            with self._lock:
+                self._stop_recording(complete=False)
+        if not self.passthrough:
+            self.track.volume = value * self.gain
+
+    def replace(self, track: discord.AudioSource, start: float):
+        "Continues playback from another track"
+        track = self._wrap(track, self.gain)
+        with self._lock:
+            old_track = self.track
+            self.track = track
+            self.start = start
+            self.frames = 0
+            self._replaced_at = time.perf_counter()
+            self._broken_at = None
+            self._recovery_abandoned = False
+            self._stop_recording(complete=False)
+        _cleaner.submit(old_track.cleanup)
+
+    def queue(
+        self,
+        track: discord.AudioSource,
+        song: Song,
+        gain: float = 1.0,
+        fade_at: Optional[float] = None,
+        recorder: Optional["Recorder"] = None,
+    ):
+        """Sets the track to play after the current one
+        It fades in from `fade_at` seconds of the current song if set"""
+        track = self._wrap(track, gain)
+        queued = QueuedTrack(
+            track, song, gain, fade_at, self._recordable(track, recorder)
+        )
+        with self._lock:
+            old, self._next = self._next, queued
+        if old:
+            _cleaner.submit(self._drop, old)
+
+    def dequeue(self):
+        "Drops the queued track"
+        with self._lock:
+            queued, self._next = self._next, None
+        if queued:
+            _cleaner.submit(self._drop, queued)
+
+    def add_overlay(self, overlay: discord.AudioSource) -> bool:
+        """Plays PCM source over the music at the same volume
+        Returns False if it can't be mixed in"""
+        if dsp.np is None or overlay.is_opus():
+            return False
+        with self._lock:
+            if self._mixer is None:
+                self._mixer = dsp.OverlayMixer()
+            if len(self._mixer) >= MAX_OVERLAYS:
+                return False
+            self._create_encoder()
+            self._mixer.add(overlay)
+            # the packets don't match the song anymore
+            self._stop_recording(complete=False)
+        return True
+
+    def abandon_recovery(self):
+        "Lets the broken track end like it was complete"
+        with self._lock:
+            self._broken_at = None
+            self._recovery_abandoned = True
+
+    def is_opus(self) -> bool:
+        return True
+
+    def read(self) -> bytes:
+        with self._lock:
+            if self._broken_at is not None:
+                waited = time.perf_counter() - self._broken_at
+                if waited < config.RECOVERY_TIMEOUT:
+                    return OPUS_SILENCE
+                self._broken_at = None
+                self._recovery_abandoned = True
+            while True:
+                try:
+                    data = self._read_track()
+                    break
+                except _Replaced:
+                    # the frame belongs to the old track, read the new one
+                    continue
+            if data is None:
+                return OPUS_SILENCE
+            if not data:
+                self._stop_recording(complete=True)
+                return b""
+            now = time.perf_counter()
+            if self._measure_gap:
+                self._measure_gap = False
+                if self.gaps is not None:
+                    self.gaps.append(
+                        max(now - self.last_frame_at - FRAME_LENGTH, 0.0)
+                    )
+            if self._replaced_at is not None:
+                if self.restarts is not None:
+                    self.restarts.append(now - self._replaced_at)
+                self._replaced_at = None
+            self.last_frame_at = now
+            self.frames += 1
+            if self._mixer:
+                data = self._mix(data)
+            elif not self.track.is_opus():
+                data = self._encoder.encode(data, Encoder.SAMPLES_PER_FRAME)
+            if self.recorder:
+                self.recorder.write(data)
+            return data
+
+    def _read(self, track: discord.AudioSource) -> bytes:
+        """Reads the track with the lock released, called with it held
+        A stalled stream must not block replacing it from the event loop,
+        raises _Replaced if the track was replaced meanwhile"""
+        error = None
+        self._lock.release()
+        try:
+            data = track.read()
+        except Exception as e:
+            # reading fails if the track was cleaned up meanwhile
+            data, error = b"", e
+        finally:
+            self._lock.acquire()
+        if track is not self.track and (
+            self._next is None or track is not self._next.track
+        ):
+            raise _Replaced
+        if error is not None:
+            raise error
+        return data
+
+    def _read_track(self) -> Optional[bytes]:
+        """Returns None if the track broke and is being recovered
+        Called with the lock held"""
+        queued = self._next
+        if queued is not None and self._is_fading(queued):
+            return self._read_fading(queued)
+
+        data = self._read(self.track)
+        # the next song could be queued or dropped while reading
+        queued = self._next
+        if not data:
+            if self._check_broken():
+                return None
+            if queued is None:
+                return data
+            self._switch(complete=True, clean_start=True)
+            return self._read(self.track)
+        if (
+            queued is not None
+            and getattr(self.track, "tail", None) is not None
+            and isinstance(queued.track, dsp.PCMProcessor)
+        ):
+            self.track.splice(queued.track)
+            # the spliced frame isn't recorded for either track
+            self._switch(complete=True, clean_start=False)
+        return data
+
+    def _mix(self, data) -> bytes:
+        "Adds the overlays to the frame and encodes it"
+        if self.track.is_opus():
+            if self._decoder is None:
+                self._decoder = Decoder()
+            packet, data = data, self._decoder.decode(data)
+            if len(data) != Encoder.FRAME_SIZE:
+                # not a 20 ms packet, overlays are added to the next one
+                return packet
+        frame = self._mixer.mix(data, self._volume)
+        if not self._mixer:
+            self._mixer = None
+            self._decoder = None
+        return self._encoder.encode(frame, Encoder.SAMPLES_PER_FRAME)
+
+    def _check_broken(self) -> bool:
+        "Called when the track ends, starts recovery if it ended early"
+        if (
+            self.on_broken is None
+            or self.duration is None
+            or self._recovery_abandoned
+            or self.position >= self.duration - EARLY_END_TOLERANCE
+        ):
+            return False
+        self._broken_at = time.perf_counter()
+        # no packets of the broken part are cached
+        self._stop_recording(complete=False)
+        self.on_broken(self.position)
+        return True
+
+    def _is_fading(self, queued: QueuedTrack) -> bool:
+        return (
+            queued.fade_at is not None
+            and self.position >= queued.fade_at
+            and isinstance(self.track, dsp.PCMProcessor)
+            and isinstance(queued.track, dsp.PCMProcessor)
+        )
+
+    def _read_fading(self, queued: QueuedTrack) -> bytes:
+        outgoing = self._read(self.track)
+        incoming = self._read(queued.track)
+        if not incoming:
+            # broken stream, it will be retried after this song
+            self._next = None
+            _cleaner.submit(self._drop, queued)
+            return outgoing
+        if not outgoing:
+            self._switch(complete=False, clean_start=False)
+            return incoming
+
+        start = (self.position - queued.fade_at) / config.CROSSFADE
+        end = min(start + FRAME_LENGTH / config.CROSSFADE, 1.0)
+        self.track.mix(queued.track, start, end)
+        if end == 1.0:
+            self._switch(complete=False, clean_start=False)
+        else:
+            queued.frames += 1
+        return outgoing
+
+    def _switch(self, complete: bool, clean_start: bool):
+        """Starts the queued track, called with the lock held
+        `complete` tells if the current track was played to the end,
+        `clean_start` if the queued one wasn't read yet"""
+        queued, old_track = self._next, self.track
+        self._next = None
+        self._stop_recording(complete)
+        self.recorder = queued.recorder
+        if not clean_start:
+            self._stop_recording(complete=False)
+        self.track = queued.track
+        self.gain = queued.gain
+        self.duration = queued.song.info.duration
+        self._recovery_abandoned = False
+        self.start = queued.frames * FRAME_LENGTH
+        self.frames = 0
+        self._measure_gap = True
+        if not self.passthrough:
+            # volume could change after the track was queued
+            self.track.volume = self._volume * self.gain
+        _cleaner.submit(old_track.cleanup)
+        if self.on_switch:
+            self.on_switch(queued.song)
+
+    def _stop_recording(self, complete: bool):
+        recorder, self.recorder = self.recorder, None
+        if recorder is None:
+            return
+        if complete:
+            recorder.finish()
+        else:
+            recorder.abort()
+
+    @staticmethod
+    def _drop(queued: QueuedTrack):
+        queued.track.cleanup()
+        if queued.recorder:
+            queued.recorder.abort()
+
+    def cleanup(self):
+        self._stop_recording(complete=False)
+        self.track.cleanup()
+        if self._mixer:
+            self._mixer.cleanup()
+        if self._next:
+            self._drop(self._next)
+            self._next = None
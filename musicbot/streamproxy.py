@@ -0,0 +1,248 @@
+import re
+import sys
+import socket
+import asyncio
+import hashlib
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+import aiohttp
+from aiohttp import web
+
+from config import config
+from musicbot.songinfo import Song
+
+SEGMENT_SIZE = 256 * 1024
+# registered streams to remember
+MAX_STREAMS = 1000
+RANGE_REGEX = re.compile(r"bytes=(\d+)-(\d*)")
+CONTENT_RANGE_REGEX = re.compile(r"bytes \d+-\d+/(\d+)")
+# failures of the upstream connection
+FETCH_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+
+_port: Optional[int] = None
+_runner: Optional[web.AppRunner] = None
+_session: Optional[aiohttp.ClientSession] = None
+
+_streams: "OrderedDict[str, _Stream]" = OrderedDict()
+# segment data by stream token and index, least recently used first
+_segments: "OrderedDict[Tuple[str, int], bytes]" = OrderedDict()
+_segments_size = 0
+_fetching: Dict[Tuple[str, int], asyncio.Task] = {}
+
+
+class Unsupported(Exception):
+    "Upstream doesn't serve byte ranges of a known size"
+
+
+class _Stream:
+    """Remote file shared by all plays of the same song format
+
+    Attributes:
+        url: The latest upstream url of the file.
+        size: Size of the file, known after the first segment is fetched.
+    """
+
+    def __init__(self, token: str, url: str):
+        self.token = token
+        self.url = url
+        self.size: Optional[int] = None
+        self.content_type = "application/octet-stream"
+
+    def segments(self) -> int:
+        return -(-self.size // SEGMENT_SIZE)
+
+    async def segment(self, index: int) -> bytes:
+        "Returns the segment, fetching it only once for all readers"
+        key = (self.token, index)
+        data = _segments.get(key)
+        # a stream registered again must learn its size from upstream
+        if data is not None and self.size is not None:
+            _segments.move_to_end(key)
+            return data
+        task = _fetching.get(key) or self._start_fetch(index)
+        # other readers may still need it if this one disconnects
+        return await asyncio.shield(task)
+
+    def read_ahead(self, index: int):
+        "Starts fetching segments after the one being read"
+        self.fetch_range(
+            index + 1,
+            index + config.STREAM_READ_AHEAD * 1024 * 1024 // SEGMENT_SIZE,
+        )
+
+    def fetch_range(self, first: int, last: int):
+        "Starts fetching segments that aren't stored or being fetched"
+        for i in range(first, min(last, self.segments() - 1) + 1):
+            key = (self.token, i)
+            if key not in _segments and key not in _fetching:
+                self._start_fetch(i)
+
+    def _start_fetch(self, index: int) -> asyncio.Task:
+        key = (self.token, index)
+        task = _fetching[key] = asyncio.create_task(self._fetch(index))
+        task.add_done_callback(lambda t: _fetch_done(key, t))
+        return task
+
+    async def _fetch(self, index: int) -> bytes:
+        start = index * SEGMENT_SIZE
+        headers = {"Range": f"bytes={start}-{start + SEGMENT_SIZE - 1}"}
+        async with _session.get(self.url, headers=headers) as response:
+            match = CONTENT_RANGE_REGEX.fullmatch(
+                response.headers.get("Content-Range", "")
+            )
+            if response.status != 206 or not match:
+                raise Unsupported()
+            self.size = int(match[1])
+            self.content_type = response.content_type
+            data = await response.read()
+        _store((self.token, index), data)
+        return data
+
+
+def _fetch_done(key: Tuple[str, int], task: asyncio.Task):
+    _fetching.pop(key, None)
+    if not task.cancelled():
+        # retrieve the exception, failed read-ahead
+        # is retried when the segment is needed
+        task.exception()
+
+
+def _store(key: Tuple[str, int], data: bytes):
+    global _segments_size
+    old = _segments.pop(key, None)
+    if old is not None:
+        _segments_size -= len(old)
+    _segments[key] = data
+    _segments_size += len(data)
+    while _segments_size > config.STREAM_CACHE_SIZE * 1024 * 1024:
+        _, old = _segments.popitem(last=False)
+        _segments_size -= len(old)
+
+
+def _stream_for(song: Song) -> Optional[_Stream]:
+    "Returns the stream of the song, None if it can't be proxied"
+    url = song.base_url
+    if (
+        _port is None
+        or url is None
+        or not url.startswith(("http://", "https://"))
+        # playlists link to other files
+        or ".m3u8" in url
+    ):
+        return None
+    key = f"{song.info.webpage_url or url}\n{song.format_id}"
+    token = hashlib.sha256(key.encode()).hexdigest()
+    stream = _streams.get(token)
+    if stream is None:
+        stream = _streams[token] = _Stream(token, url)
+        if len(_streams) > MAX_STREAMS:
+            _streams.popitem(last=False)
+    else:
+        # signed urls expire, the file stays the same
+        stream.url = url
+        _streams.move_to_end(token)
+    return stream
+
+
+def url_for(song: Song) -> str:
+    "Returns local url FFmpeg should read the song from"
+    stream = _stream_for(song)
+    if stream is None:
+        return song.base_url
+    return f"http://127.0.0.1:{_port}/{stream.token}"
+
+
+async def prefetch(song: Song):
+    """Fetches the first PREFETCH_TIME seconds of the song,
+    so it starts from memory and continues from the network"""
+    stream = _stream_for(song)
+    if stream is None or not song.info.duration:
+        return
+    try:
+        # tells the size of the file
+        await stream.segment(0)
+    except (Unsupported, *FETCH_ERRORS):
+        return
+    head = config.PREFETCH_TIME * stream.size / song.info.duration
+    stream.fetch_range(1, int(head // SEGMENT_SIZE))
+
+
+async def _handle(request: web.Request) -> web.StreamResponse:
+    stream = _streams.get(request.match_info["token"])
+    if stream is None:
+        raise web.HTTPNotFound()
+
+    match = RANGE_REGEX.fullmatch(request.headers.get("Range", ""))
+    start = int(match[1]) if match else 0
+    try:
+        first = await stream.segment(start // SEGMENT_SIZE)
+    except Unsupported:
+        # let FFmpeg read it directly
+        raise web.HTTPTemporaryRedirect(stream.url)
+    except FETCH_ERRORS as e:
+        print("Stream proxy failed to fetch:", repr(e), file=sys.stderr)
+        # the origin may still work for FFmpeg
+        raise web.HTTPTemporaryRedirect(stream.url)
+    if start >= stream.size:
+        raise web.HTTPRequestRangeNotSatisfiable(
+            headers={"Content-Range": f"bytes */{stream.size}"}
+        )
+    end = stream.size - 1
+    if match and match[2]:
+        end = min(int(match[2]), end)
+
+    response = web.StreamResponse(
+        status=206 if match else 200,
+        headers={
+            "Accept-Ranges": "bytes",
+            "Content-Type": stream.content_type,
+            "Content-Length": str(end - start + 1),
+        },
+    )
+    if match:
+        response.headers["Content-Range"] = (
+            f"bytes {start}-{end}/{stream.size}"
+        )
+    await response.prepare(request)
+
+    index, position = divmod(start, SEGMENT_SIZE)
+    data = first
+    while True:
+        stream.read_ahead(index)
+        chunk_end = min(end + 1 - index * SEGMENT_SIZE, len(data))
+        await response.write(memoryview(data)[position:chunk_end])
+        index += 1
+        position = 0
+        if index * SEGMENT_SIZE > end:
+            break
+        try:
+            data = await stream.segment(index)
+        except (Unsupported, *FETCH_ERRORS) as e:
+            # FFmpeg reconnects from where it stopped
+            print("Stream proxy failed to fetch:", repr(e), file=sys.stderr)
+            break
+    return response
+
+
+async def start():
+    "Starts the proxy on a random local port"
+    global _port, _runner, _session
+    _session = aiohttp.ClientSession()
+    app = web.Application()
+    app.router.add_get("/{token}", _handle)
+    _runner = web.AppRunner(app, access_log=None)
+    await _runner.setup()
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    await web.SockSite(_runner, sock).start()
+    _port = sock.getsockname()[1]
+
+
+async def stop():
+    global _port
+    _port = None
+    if _runner:
+        await _runner.cleanup()
+    if _session:
+        await _session.close()
@@ -0,0 +1,109 @@
+import time
+import asyncio
+import threading
+from collections import deque
+from typing import Deque, Optional, Tuple
+
+import discord
+
+# reconnects to remember
+RECONNECT_HISTORY = 20
+
+
+class _ConnectedEvent(threading.Event):
+    "Connection flag of the voice client that remembers when it was lost"
+
+    def __init__(self):
+        super().__init__()
+        self.lost_at: Optional[float] = None
+
+    def clear(self):
+        if self.is_set():
+            self.lost_at = time.perf_counter()
+        super().clear()
+
+
+class ReconnectStats:
+    """Reconnects of one voice client
+
+    Attributes:
+        reconnects: Number of times the connection came back.
+        latencies: Seconds from the connection being lost and from
+            the new connection being ready to the next audio packet.
+    """
+
+    def __init__(self):
+        self.reconnects = 0
+        self.latencies: Deque[Tuple[float, float]] = deque(
+            maxlen=RECONNECT_HISTORY
+        )
+
+    def __str__(self):
+        if not self.latencies:
+            return f"{self.reconnects} reconnects"
+        outages = sorted(outage for outage, _ in self.latencies)
+        latencies = sorted(latency for _, latency in self.latencies)
+        return (
+            "{} reconnects, median {:.0f} ms offline, median {:.0f} ms"
+            " and max {:.0f} ms from reconnect to audio".format(
+                self.reconnects,
+                outages[len(outages) // 2] * 1000,
+                latencies[len(latencies) // 2] * 1000,
+                latencies[-1] * 1000,
+            )
+        )
+
+
+class VoiceClient(discord.VoiceClient):
+    """Voice client that keeps playing across channel moves and reconnects
+    The player and its source survive while the connection is replaced,
+    sending resumes as soon as the new connection is ready
+
+    Attributes:
+        reconnect_stats: Reconnects and their latency to audio.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._connected = _ConnectedEvent()
+        self._reconnected = asyncio.Event()
+        # when the new connection was ready, until the next packet
+        self._reconnected_at: Optional[float] = None
+        self.reconnect_stats = ReconnectStats()
+
+    async def connect_websocket(self):
+        ws = await super().connect_websocket()
+        if self._connected.lost_at is not None:
+            self.reconnect_stats.reconnects += 1
+            self._reconnected_at = time.perf_counter()
+            if self.is_playing():
+                # the speaking state belongs to the old connection
+                await ws.speak(True)
+        self._reconnected.set()
+        return ws
+
+    async def wait_connected(self, timeout: float) -> bool:
+        """Waits until the connection is ready, it's replaced
+        for a moment after moves. Returns False on timeout"""
+        if self.is_connected():
+            return True
+        self._reconnected.clear()
+        try:
+            await asyncio.wait_for(self._reconnected.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return self.is_connected()
+
+    def cleanup(self):
+        super().cleanup()
+        # the connection won't come back, wake the waiters
+        self._reconnected.set()
+
+    def send_audio_packet(self, data: bytes, *, encode: bool = True):
+        super().send_audio_packet(data, encode=encode)
+        if self._reconnected_at is not None:
+            now = time.perf_counter()
+            self.reconnect_stats.latencies.append(
+                (now - self._connected.lost_at, now - self._reconnected_at)
+            )
+            self._reconnected_at = None
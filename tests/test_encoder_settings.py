@@ -0,0 +1,30 @@
+import io
+
+import discord
+
+from musicbot import encoding, sources
+
+LOWERED = encoding.EncoderSettings(64, 6, False)
+
+
+class PCMTrack(discord.AudioSource):
+    "Silence read like FFmpegPCMAudio"
+
+    def __init__(self):
+        self._stdout = io.BytesIO(b"\0" * discord.opus.Encoder.FRAME_SIZE * 10)
+
+    def read(self):
+        return self._stdout.read(discord.opus.Encoder.FRAME_SIZE)
+
+
+def test_reset_while_playing(monkeypatch):
+    configured = []
+    monkeypatch.setattr(
+        encoding, "configure", lambda _, settings: configured.append(settings)
+    )
+    source = sources.PlaybackSource(PCMTrack(), 1.0, encoder_settings=LOWERED)
+    assert source.read()
+    source.encoder_settings = None
+    assert source.read()
+    assert source.encoder_settings is None
+    assert configured == [LOWERED, encoding.DEFAULT_SETTINGS]
@@ -0,0 +1,70 @@
+import asyncio
+import types
+
+from config import config
+from musicbot import governor, scheduler
+
+
+class DbSession:
+    def __init__(self):
+        self.added = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    def add(self, transition):
+        self.added.append(transition)
+
+    async def commit(self):
+        pass
+
+
+class AudioController:
+    def __init__(self, broken=False):
+        self.broken = broken
+        self.levels = []
+
+    def apply_quality(self):
+        self.levels.append(governor.level)
+        if self.broken:
+            raise RuntimeError("broken")
+
+
+def test_recovers_to_level_0(monkeypatch):
+    counters = [0, 0]
+    monkeypatch.setattr(scheduler, "counters", lambda: tuple(counters))
+    monkeypatch.setattr(governor, "level", 0)
+    monkeypatch.setattr(governor, "_last_check", None)
+    monkeypatch.setattr(governor, "_calm_checks", 0)
+    session = DbSession()
+    broken, working = AudioController(broken=True), AudioController()
+    bot = types.SimpleNamespace(
+        DbSession=lambda: session,
+        audio_controllers={1: broken, 2: working},
+    )
+
+    async def check(late: int):
+        counters[0] += 1000
+        counters[1] += late
+        await governor.check(bot)
+
+    async def run():
+        await governor.check(bot)
+        # every frame late
+        await check(1000)
+        assert governor.level == 1
+        for _ in range(governor.RECOVERY_CHECKS):
+            await check(0)
+
+    # checks in a row measure the CPU over almost no time
+    monkeypatch.setattr(config, "GOVERNOR_MAX_CPU", float("inf"))
+    asyncio.run(run())
+    assert governor.level == 0
+    assert broken.levels == working.levels == [1, 0]
+    assert [(t.from_level, t.to_level) for t in session.added] == [
+        (0, 1),
+        (1, 0),
+    ]
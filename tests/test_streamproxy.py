@@ -0,0 +1,61 @@
+import os
+import asyncio
+
+import aiohttp
+from aiohttp import web
+
+from musicbot import streamproxy
+from musicbot.linkutils import Origins, Sites
+from musicbot.songinfo import Song
+
+DATA = os.urandom(3 * streamproxy.SEGMENT_SIZE + 1234)
+
+
+async def _upstream(request: web.Request) -> web.Response:
+    match = streamproxy.RANGE_REGEX.fullmatch(request.headers["Range"])
+    start, end = int(match[1]), int(match[2])
+    end = min(end, len(DATA) - 1)
+    return web.Response(
+        status=206,
+        body=DATA[start : end + 1],
+        headers={"Content-Range": f"bytes {start}-{end}/{len(DATA)}"},
+    )
+
+
+def _song(port: int, name: str) -> Song:
+    return Song(
+        Origins.Default,
+        Sites.Custom,
+        base_url=f"http://127.0.0.1:{port}/{name}",
+        duration=60,
+        webpage_url=f"https://example.com/{name}",
+    )
+
+
+def test_segments_outlive_evicted_stream(monkeypatch):
+    monkeypatch.setattr(streamproxy, "MAX_STREAMS", 1)
+
+    async def run():
+        app = web.Application()
+        app.router.add_get("/{name}", _upstream)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        await streamproxy.start()
+        try:
+            song = _song(port, "song")
+            await streamproxy.prefetch(song)
+            # pushes the stream of the song out, its segments stay
+            streamproxy.url_for(_song(port, "other"))
+            await streamproxy.prefetch(song)
+            async with aiohttp.ClientSession() as session:
+                async with session.get(streamproxy.url_for(song)) as response:
+                    assert response.status == 200
+                    assert await response.read() == DATA
+        finally:
+            await streamproxy.stop()
+            await runner.cleanup()
+
+    asyncio.run(run())